@@ -1,5 +1,9 @@
+from __future__ import annotations
+
 from typing import Iterator
 
+import numpy as np
+
 from tree_sitter_wrapper.tree import TreeSitterTree
 
 from common.root_path import RootPath
@@ -7,12 +11,57 @@ from change_tree import node
 
 
 class ChangeTree:
-    def __init__(self, before_tree: TreeSitterTree, after_tree: TreeSitterTree, max_root_paths = 400):
-        self.before_paths = before_tree.get_random_root_paths(max_root_paths)
-        self.after_paths = after_tree.get_random_root_paths(max_root_paths)
-
+    def __init__(self, before_tree: TreeSitterTree, after_tree: TreeSitterTree, max_root_paths = 400,
+                 changed_ranges: tuple[list[tuple[int, int]], list[tuple[int, int]]] | None = None,
+                 n_context_leaves: int = 2):
+        """
+        Sample the root paths of the before and after trees. If the changed byte ranges of the two states are given
+        (see tree_sitter_wrapper.tree.get_changed_ranges), only the paths to the leaves in and next to them are
+        sampled, otherwise the paths are randomly sampled from the whole trees.
+        """
+        if changed_ranges is None:
+            self.before_paths = before_tree.get_random_root_paths(max_root_paths)
+            self.after_paths = after_tree.get_random_root_paths(max_root_paths)
+        else:
+            before_ranges, after_ranges = changed_ranges
+            self.before_paths = before_tree.get_change_focused_root_paths(max_root_paths, before_ranges,
+                                                                          n_context_leaves)
+            self.after_paths = after_tree.get_change_focused_root_paths(max_root_paths, after_ranges,
+                                                                        n_context_leaves)
+
+        # (before only, after only) path context arrays, see path_context.extractor.PathContextExtractor
+        self.path_contexts: tuple[np.ndarray, np.ndarray] | None = None
+        # The tokens and paths of the ids in path_contexts
+        self.path_context_strings: dict[int, str] | None = None
+        # AST node counts of the (before, after) methods
+        self.method_sizes: tuple[int, int] | None = None
         self.root = None
 
+    @classmethod
+    def from_root_paths(cls, before_paths: list[RootPath], after_paths: list[RootPath],
+                        path_contexts: tuple[np.ndarray, np.ndarray] | None = None,
+                        method_sizes: tuple[int, int] | None = None,
+                        path_context_strings: dict[int, str] | None = None) -> ChangeTree:
+        """
+        Construct a ChangeTree from already sampled root paths.
+
+        Args:
+            before_paths: Root paths of the before state of the code change
+            after_paths: Root paths of the after state of the code change
+            path_contexts: Path contexts only in the before and only in the after state, if extracted
+            method_sizes: AST node counts of the before and after methods
+            path_context_strings: The tokens and paths of the ids in path_contexts
+        """
+        ch_tree = cls.__new__(cls)
+        ch_tree.before_paths = before_paths
+        ch_tree.after_paths = after_paths
+        ch_tree.path_contexts = path_contexts
+        ch_tree.method_sizes = method_sizes
+        ch_tree.path_context_strings = path_context_strings
+        ch_tree.root = None
+
+        return ch_tree
+
     def get_root(self) -> node.Node:
         """
         Get the ChangeTree root
@@ -74,6 +123,13 @@ class ChangeTree:
         """
         self.create_path_diffs(self.after_paths, self.before_paths)
 
+    def drop_paths(self) -> None:
+        """
+        Drop the sampled root paths once the change tree is created, the nodes of the changed paths are kept by the root.
+        """
+        self.before_paths = []
+        self.after_paths = []
+
     def add_root_path(self, root_path: list[node.Node]) -> None:
         """
         Add a root path to construct the change tree.
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Literal
 
 from pydantic import BaseModel
 import yaml
@@ -11,6 +12,35 @@ class Config(BaseModel):
     summer23_dataset_path: str
     summer23_chtree_root: str
     log_file: str
+    max_root_paths: int = 400
+    root_paths_per_node: float | None = None
+    min_root_paths: int = 50
+    sampling_strategy: Literal["random", "change_focused"] = "random"
+    n_context_leaves: int = 2
+    pipeline_cache_root: str | None = None
+    failure_ledger_path: str | None = None
+    catalog_path: str | None = None
+    skip_cataloged: bool = False
+    source_backend: Literal["http", "git"] = "http"
+    git_mirrors_root: str | None = None
+    extract_path_contexts: bool = False
+    max_path_length: int = 8
+    max_path_width: int = 2
+    max_path_contexts: int = 200
+    pipelined: bool = False
+    fetch_workers: int = 8
+    build_workers: int | None = None
+    persist_workers: int = 2
+    pipeline_queue_size: int = 64
+    group_by_file: bool = False
+    max_file_size: int | None = None
+    max_method_nodes: int | None = None
+    parse_timeout: float | None = None
+    sample_timeout: float | None = None
+    build_timeout: float | None = None
+    memory_accounting: bool = False
+    memory_limit_mb: int | None = None
+    memory_snapshot_interval: int = 100
 
 
 def get_config():
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from pathlib import Path
+import subprocess
+import threading
+
+# Requests up to this size fit into the pipe buffer, so they can be written without a writer thread
+MAX_UNTHREADED_REQUEST_SIZE = 16384
+
+
+class GitCatFile:
+    """
+    A long-lived "git cat-file --batch" process of a repository. Object requests are pipelined: every request of a
+    batch is written before the responses are read, so a batch costs a single round trip.
+
+    """
+
+    def __init__(self, repo_path: Path | str):
+        self.repo_path = Path(repo_path)
+        self.process = subprocess.Popen(["git", "--git-dir", str(self.repo_path), "cat-file", "--batch"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+
+    def write_requests(self, request: bytes) -> None:
+        self.process.stdin.write(request)
+        self.process.stdin.flush()
+
+    def read_object(self) -> bytes | None:
+        header = self.process.stdout.readline()
+        if not header:
+            raise RuntimeError(f"git cat-file of '{self.repo_path}' exited unexpectedly")
+
+        # "<object> missing" or "<object> ambiguous", the object name can contain spaces
+        if header.rstrip().endswith((b" missing", b" ambiguous")):
+            return None
+
+        # "<sha> <type> <size>"
+        fields = header.split()
+        content = self.process.stdout.read(int(fields[2]))
+        self.process.stdout.read(1)
+
+        return content if fields[1] == b"blob" else None
+
+    def read_many(self, revisions: list[str]) -> list[bytes | None]:
+        """
+        Read the blobs of some revisions
+
+        Args:
+            revisions: Object names, e.g. "<sha>:<path>"
+
+        Returns: The content of each blob, or None if it does not exist or is not a blob
+
+        """
+        request = "".join(f"{revision}\n" for revision in revisions).encode()
+
+        with self.lock:
+            writer = None
+            if len(request) <= MAX_UNTHREADED_REQUEST_SIZE:
+                self.write_requests(request)
+            else:
+                # Writing a large batch would block on a full pipe while git blocks on writing its responses
+                writer = threading.Thread(target=self.write_requests, args=(request,))
+                writer.start()
+
+            try:
+                contents = [self.read_object() for _ in revisions]
+            except BaseException:
+                # The rest of the responses would be read by the next batch, the process is replaced instead
+                self.process.kill()
+                self.process.wait()
+                raise
+            finally:
+                if writer:
+                    writer.join()
+
+        return contents
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+class LocalGitBackend:
+    """
+    Reads file versions from local bare clones (mirrors) of the repositories, laid out as <mirrors_root>/<repo>.git
+    where repo is "<owner>/<name>". One GitCatFile process is kept per repository.
+
+    """
+
+    def __init__(self, mirrors_root: Path | str):
+        self.mirrors_root = Path(mirrors_root)
+        self.cat_files: dict[str, GitCatFile] = {}
+        self.lock = threading.Lock()
+
+    def get_repo_path(self, repo: str) -> Path:
+        return self.mirrors_root / f"{repo}.git"
+
+    def has_repo(self, repo: str) -> bool:
+        return repo in self.cat_files or self.get_repo_path(repo).is_dir()
+
+    def read_files(self, repo: str, files: list[tuple[str, str]]) -> list[bytes | None]:
+        """
+        Read file versions of a repository in one pipelined batch
+
+        Args:
+            repo: The repository ("<owner>/<name>")
+            files: List of (commit sha, file path) tuples
+
+        Returns: The content of each file, or None if it does not exist in the commit
+
+        """
+        with self.lock:
+            cat_file = self.cat_files.get(repo)
+            if cat_file is None or not cat_file.is_alive():
+                # Started on the first request of the repository, restarted if it died
+                cat_file = self.cat_files[repo] = GitCatFile(self.get_repo_path(repo))
+
+        revisions = []
+        for sha, filepath in files:
+            posix_filepath = filepath.replace("\\", "/")
+            revisions.append(f"{sha.strip()}:{posix_filepath}")
+
+        return cat_file.read_many(revisions)
+
+    def close(self) -> None:
+        for cat_file in self.cat_files.values():
+            cat_file.close()
+        self.cat_files.clear()
+
+    def __enter__(self) -> LocalGitBackend:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -1,7 +1,13 @@
+from collections import Counter
 from functools import partial
+from itertools import chain
 from pathlib import Path
+from typing import Iterator
 import pickle
 import logging
+import os
+import threading
+import time
 from logging.handlers import RotatingFileHandler
 
 
@@ -11,22 +17,47 @@ from tqdm import tqdm
 from common.commit_method import csv_line_parser_base, CommitMethodDefinition
 from common.config import CONFIG
 from common.util.figure import get_lines_from_file, dump_tree_to_png
+from common.util.git_objects import LocalGitBackend
 from common.util.misc import download_file
 from change_tree.tree import ChangeTree
-from tree_sitter_wrapper.tree import get_sitter_AST_method
+from path_context.extractor import PathContextExtractor
+from pipeline.budgets import check_file_sizes, check_method_nodes, get_root_path_budget, time_limit
+from pipeline.catalog import Catalog, CatalogEntry
+from pipeline.failure_ledger import FailureLedger, ParseError, MethodNotFoundError, DiffError, SourceNotFoundError, \
+    BudgetExceededError
+from pipeline.memory import MemoryAccountant, memory_tracked, set_accountant, stop_tracing, track_memory
+from pipeline.scheduler import Stage, StagedPipeline
+from pipeline.stage_cache import StageCache, hash_bytes, hash_json
+from tree_sitter_wrapper.tree import TreeSitterTree, get_sitter_AST_bytes, get_changed_ranges, get_method_from_index
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('[%(asctime)s| %(levelname)s] %(message)s', datefmt="%y. %m. %d %H:%M")
-file_handler = RotatingFileHandler(CONFIG.log_file, maxBytes=10000000, backupCount=2)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+
+
+def setup_logging(rotate: bool = True) -> None:
+    """
+    Log to CONFIG.log_file. Called by the entry points, not on import, so the pool processes importing this module do
+    not open handlers of their own on the same file. Several processes logging to the file must not rotate it.
+    """
+    if logger.handlers:
+        return
+
+    formatter = logging.Formatter('[%(asctime)s| %(levelname)s] %(message)s', datefmt="%y. %m. %d %H:%M")
+    file_handler = RotatingFileHandler(CONFIG.log_file, maxBytes=10000000, backupCount=2) if rotate \
+        else logging.FileHandler(CONFIG.log_file)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
 
 parse_pre_commit_method_def = \
     partial(csv_line_parser_base, repo_idx=0, sha_idx=8, filepath_idx=3, url_idx=1, identifier_idx=7, pos_idx=5)
 parse_post_commit_method_def = \
     partial(csv_line_parser_base, repo_idx=0, sha_idx=9, filepath_idx=4, url_idx=2, identifier_idx=7, pos_idx=6)
 
+# (pid, backend) of the git object backend, a forked process must not share the git processes of its parent
+_git_backend: tuple[int, LocalGitBackend] | None = None
+# Path context extractor of each thread, shared by the rows the thread builds
+_thread_locals = threading.local()
+
 
 def get_dst_path(commit_method: CommitMethodDefinition) -> Path:
     """
@@ -47,30 +78,195 @@ def get_dst_path(commit_method: CommitMethodDefinition) -> Path:
         Path(commit_method.filepath).name
 
 
+def get_git_backend() -> LocalGitBackend | None:
+    """
+    Get the git object backend of the process if source_backend is "git" in the config
+    """
+    global _git_backend
+
+    if CONFIG.source_backend != "git":
+        return None
+    if not CONFIG.git_mirrors_root:
+        raise ValueError("git_mirrors_root must be set in the config for the git source backend")
+
+    if _git_backend is None or _git_backend[0] != os.getpid():
+        _git_backend = (os.getpid(), LocalGitBackend(CONFIG.git_mirrors_root))
+
+    return _git_backend[1]
+
+
+def get_path_context_extractor() -> PathContextExtractor:
+    if getattr(_thread_locals, "extractor", None) is None:
+        _thread_locals.extractor = PathContextExtractor(CONFIG.max_path_length, CONFIG.max_path_width,
+                                                        CONFIG.max_path_contexts)
+
+    return _thread_locals.extractor
+
+
+def uses_git_backend(commit_method: CommitMethodDefinition) -> bool:
+    git_backend = get_git_backend()
+    return git_backend is not None and git_backend.has_repo(commit_method.repo)
+
+
+@memory_tracked("fetch")
+def read_commit_files(pre_commit_method: CommitMethodDefinition, post_commit_method: CommitMethodDefinition,
+                      ledger: FailureLedger | None = None) -> tuple[bytes, bytes]:
+    """
+    Get the content of the files of the pre and post commit states. They are read from the local mirror of the
+    repository with the git source backend, otherwise (or if the repository is not mirrored) they are downloaded.
+
+    Args:
+        pre_commit_method: a CommitMethod object for the pre commit state
+        post_commit_method: a CommitMethod object for the post commit state
+        ledger: Failure ledger used for the downloads
+
+    Returns: Tuple of: pre file content, post file content
+
+    """
+    if uses_git_backend(post_commit_method):
+        pre_content, post_content = get_git_backend().read_files(post_commit_method.repo, [
+            (pre_commit_method.sha, pre_commit_method.filepath),
+            (post_commit_method.sha, post_commit_method.filepath),
+        ])
+        for commit_method, content in ((pre_commit_method, pre_content), (post_commit_method, post_content)):
+            if content is None:
+                raise SourceNotFoundError(f"File '{commit_method.filepath}' not found in commit "
+                                          f"'{commit_method.sha.strip()}' of the mirror of '{commit_method.repo}'")
+        return pre_content, post_content
+
+    download_commit_file(pre_commit_method, ledger)
+    download_commit_file(post_commit_method, ledger)
+
+    with get_dst_path(pre_commit_method).open("rb") as fp:
+        pre_content = fp.read()
+    with get_dst_path(post_commit_method).open("rb") as fp:
+        post_content = fp.read()
+
+    return pre_content, post_content
+
+
+@memory_tracked("parse")
+def parse_commit_files(pre_content: bytes, post_content: bytes) \
+        -> tuple[TreeSitterTree, TreeSitterTree, tuple[list, list] | None]:
+    """
+    Parse the files of the pre and post commit states within the file size and parse time budgets. The changed ranges
+    are only computed for the change focused sampling strategy, the line diff they need counts to the parse time.
+
+    Args:
+        pre_content: The file content of the pre commit state
+        post_content: The file content of the post commit state
+
+    Returns: Tuple of: pre file tree, post file tree, (pre changed ranges, post changed ranges) or None
+
+    """
+    check_file_sizes((pre_content, post_content), CONFIG.max_file_size)
+
+    try:
+        if CONFIG.sampling_strategy == "change_focused":
+            with time_limit(CONFIG.parse_timeout, "parse_timeout"):
+                pre_file_tree, post_file_tree, pre_ranges, post_ranges = \
+                    get_changed_ranges(pre_content, post_content, CONFIG.parse_timeout)
+            return pre_file_tree, post_file_tree, (pre_ranges, post_ranges)
+
+        start = time.perf_counter()
+        pre_file_tree = get_sitter_AST_bytes(pre_content, CONFIG.parse_timeout)
+        remaining = CONFIG.parse_timeout and max(CONFIG.parse_timeout - (time.perf_counter() - start), 1e-6)
+        return pre_file_tree, get_sitter_AST_bytes(post_content, remaining), None
+    except TimeoutError as ex:
+        raise BudgetExceededError("parse_timeout", f"Parsing did not finish in {CONFIG.parse_timeout}s") from ex
+    except BudgetExceededError:
+        raise
+    except Exception as ex:
+        raise ParseError(f"Failed to parse commit files: {ex}") from ex
+
+
+def check_methods_found(pre_tree: TreeSitterTree | None, post_tree: TreeSitterTree | None,
+                        commit_method: CommitMethodDefinition) -> None:
+    if pre_tree is None or post_tree is None:
+        raise MethodNotFoundError(f"Method '{commit_method.identifier}' not found in '{commit_method.filepath}' "
+                                  f"({'pre' if pre_tree is None else 'post'} state)")
+
+
+@memory_tracked("build")
+def build_chtree(pre_tree: TreeSitterTree, post_tree: TreeSitterTree, changed_ranges: tuple[list, list] | None) \
+        -> ChangeTree:
+    """
+    Build the change tree of the located methods within the method size, sampling time and build time budgets. The
+    number of sampled root paths scales with the size of the larger method if root_paths_per_node is configured.
+    """
+    method_sizes = (pre_tree.root.raw_node.descendant_count, post_tree.root.raw_node.descendant_count)
+    n_nodes = max(method_sizes)
+    check_method_nodes(n_nodes, CONFIG.max_method_nodes)
+    max_root_paths = get_root_path_budget(n_nodes, CONFIG.max_root_paths, CONFIG.root_paths_per_node,
+                                          CONFIG.min_root_paths)
+
+    try:
+        with time_limit(CONFIG.sample_timeout, "sample_timeout"):
+            ch_tree = ChangeTree(pre_tree, post_tree, max_root_paths, changed_ranges, CONFIG.n_context_leaves)
+        ch_tree.method_sizes = method_sizes
+        if CONFIG.extract_path_contexts:
+            extractor = get_path_context_extractor()
+            try:
+                with time_limit(CONFIG.build_timeout, "build_timeout"):
+                    ch_tree.path_contexts = extractor.extract_changed(pre_tree, post_tree)
+            finally:
+                ch_tree.path_context_strings = extractor.pop_strings()
+    except BudgetExceededError:
+        raise
+    except Exception as ex:
+        raise DiffError(f"Failed to build change tree: {ex}") from ex
+
+    return ch_tree
+
+
 def chtree_from_commit_methods(pre_commit_method: CommitMethodDefinition,
-                               post_commit_method: CommitMethodDefinition) -> ChangeTree:
+                               post_commit_method: CommitMethodDefinition,
+                               ledger: FailureLedger | None = None) -> ChangeTree:
     """
     Get a ChangeTree object for a commit method
 
     Args:
         pre_commit_method: a CommitMethod object for the pre commit state
         post_commit_method: a CommitMethod object for the post commit state
+        ledger: Failure ledger used for the downloads
 
     Returns: ChangeTree object
 
     """
-    pre_tree = get_sitter_AST_method(get_dst_path(pre_commit_method), pre_commit_method)
-    post_tree = get_sitter_AST_method(get_dst_path(post_commit_method), post_commit_method)
+    pre_content, post_content = read_commit_files(pre_commit_method, post_commit_method, ledger)
 
-    return ChangeTree(pre_tree, post_tree)
+    return chtree_from_contents(pre_content, post_content, pre_commit_method, post_commit_method)
 
 
-def download_commit_file(commit_method: CommitMethodDefinition) -> None:
+def chtree_from_contents(pre_content: bytes, post_content: bytes, pre_commit_method: CommitMethodDefinition,
+                         post_commit_method: CommitMethodDefinition) -> ChangeTree:
+    """
+    Get a ChangeTree object for a commit method from the already read pre and post files
+
+    Args:
+        pre_content: The file content of the pre commit state
+        post_content: The file content of the post commit state
+        pre_commit_method: a CommitMethod object for the pre commit state
+        post_commit_method: a CommitMethod object for the post commit state
+
+    Returns: ChangeTree object
+
+    """
+    pre_file_tree, post_file_tree, changed_ranges = parse_commit_files(pre_content, post_content)
+    pre_tree = pre_file_tree.get_method_by_pos(pre_commit_method.line, pre_commit_method.col)
+    post_tree = post_file_tree.get_method_by_pos(post_commit_method.line, post_commit_method.col)
+    check_methods_found(pre_tree, post_tree, post_commit_method)
+
+    return build_chtree(pre_tree, post_tree, changed_ranges)
+
+
+def download_commit_file(commit_method: CommitMethodDefinition, ledger: FailureLedger | None = None) -> None:
     """
     Downloads the file corresponding to the commit method
 
     Args:
         commit_method: The commit method to get the containing file for
+        ledger: If given, URLs with known failures are not requested again and new failures are recorded
 
     Returns: None
 
@@ -80,16 +276,28 @@ def download_commit_file(commit_method: CommitMethodDefinition) -> None:
     if dst_file_path.exists():
         return
 
-    download_file(commit_method.url, dst_file_path)
+    if ledger is None:
+        download_file(commit_method.url, dst_file_path)
+        return
+
+    ledger.raise_if_known(commit_method.url)
+    try:
+        download_file(commit_method.url, dst_file_path)
+    except requests.exceptions.RequestException as ex:
+        ledger.record(commit_method.url, ex)
+        raise
+    ledger.clear(commit_method.url)
 
 
-def parse_csv_line(line: str) -> tuple[ChangeTree, CommitMethodDefinition, CommitMethodDefinition]:
+def parse_csv_line(line: str, ledger: FailureLedger | None = None) \
+        -> tuple[ChangeTree, CommitMethodDefinition, CommitMethodDefinition]:
     """
-    Parse a csv line  after downloading the files needed for it (files corresponding to pre and
-    post states)
+    Parse a csv line  after downloading (or reading from the local mirror) the files needed for it (files corresponding
+    to pre and post states)
 
     Args:
         line: The line to parse
+        ledger: Failure ledger used for the downloads
 
     Returns: Tuple of: the change tree based on csv line, pre-commit method, post-commit method
 
@@ -97,54 +305,567 @@ def parse_csv_line(line: str) -> tuple[ChangeTree, CommitMethodDefinition, Commi
     pre_method = parse_pre_commit_method_def(line)
     post_method = parse_post_commit_method_def(line)
 
-    download_commit_file(pre_method)
-    download_commit_file(post_method)
+    return chtree_from_commit_methods(pre_method, post_method, ledger), pre_method, post_method
+
+
+def get_chtree_path(commit_method: CommitMethodDefinition, chtree_root: Path | str | None = None) -> Path:
+    """
+    Get the path where the change tree of a commit method is saved
 
-    return chtree_from_commit_methods(pre_method, post_method), pre_method, post_method
+    Args:
+        commit_method: The (post) commit method of the change tree
+        chtree_root: The change tree save root, defaults to summer23_chtree_root
 
+    Returns: Path object for the pickled change tree
 
-def save_chtree(ch_tree: ChangeTree, commit_method: CommitMethodDefinition) -> Path:
+    """
     repo_part = commit_method.repo.replace("/", "_")
     filename_part = Path(commit_method.filepath).name.replace(".", "_")
+    chtree_root = chtree_root or CONFIG.summer23_chtree_root
 
-    dst_path = Path(CONFIG.summer23_chtree_root) / f"{repo_part}_{commit_method.sha}" / filename_part / \
-        f"{commit_method.identifier}.pkl"
+    return Path(chtree_root) / f"{repo_part}_{commit_method.sha}" / filename_part / f"{commit_method.identifier}.pkl"
 
+
+@memory_tracked("persist")
+def save_chtree(ch_tree: ChangeTree, commit_method: CommitMethodDefinition,
+                chtree_root: Path | str | None = None) -> Path:
+    dst_path = get_chtree_path(commit_method, chtree_root)
     dst_path.parent.mkdir(exist_ok=True, parents=True)
 
     with dst_path.open("wb") as fp:
         pickle.dump(ch_tree, fp)
 
+    return dst_path
+
+
+def hash_file(path: Path) -> str:
+    with path.open("rb") as fp:
+        return hash_bytes(fp.read())
+
+
+def get_row_key(line: str) -> str:
+    return hash_bytes(line.strip().encode())
+
+
+def get_catalog_entry(line: str, ch_tree: ChangeTree, post_method: CommitMethodDefinition,
+                      timings: dict[str, float]) -> CatalogEntry:
+    """
+    Get the catalog entry of a processed csv line
+
+    Args:
+        line: The csv line
+        ch_tree: Its change tree
+        post_method: Its post-commit method
+        timings: Seconds spent on the processing steps of the line
+
+    Returns: The catalog entry
+
+    """
+    before_only = set(ch_tree.before_paths).difference(ch_tree.after_paths)
+    after_only = set(ch_tree.after_paths).difference(ch_tree.before_paths)
+
+    changed_node_types = {}
+    for root_path in chain(before_only, after_only):
+        changed_node_types.update(zip(root_path.node_ids, (node.type for node in root_path.path)))
+    type_histogram = dict(Counter(changed_node_types.values()))
+
+    return CatalogEntry(
+        row_key=get_row_key(line),
+        repo=post_method.repo,
+        sha=post_method.sha.strip(),
+        filepath=post_method.filepath,
+        identifier=post_method.identifier,
+        line=post_method.line,
+        col=post_method.col,
+        chtree_path=str(get_chtree_path(post_method)),
+        pre_nodes=ch_tree.method_sizes[0] if ch_tree.method_sizes else None,
+        post_nodes=ch_tree.method_sizes[1] if ch_tree.method_sizes else None,
+        before_paths=len(ch_tree.before_paths),
+        after_paths=len(ch_tree.after_paths),
+        changed_before_paths=len(before_only),
+        changed_after_paths=len(after_only),
+        changed_nodes=len(changed_node_types),
+        path_contexts=sum(map(len, ch_tree.path_contexts)) if ch_tree.path_contexts else None,
+        type_histogram=type_histogram,
+        timings=timings,
+        processed_at=time.time(),
+    )
+
+
+def parse_csv_line_cached(line: str, chtree_root: Path | str | None = None, ledger: FailureLedger | None = None) \
+        -> tuple[ChangeTree, CommitMethodDefinition, CommitMethodDefinition]:
+    """
+    Parse a csv line and save its change tree while only recomputing the stages (fetch, parse, locate, sample, build,
+    save) whose inputs or parameters changed since the last run. See pipeline.stage_cache.StageCache.
+
+    Args:
+        line: The line to parse
+        chtree_root: The change tree save root, defaults to summer23_chtree_root
+        ledger: Failure ledger used for the downloads
+
+    Returns: Tuple of: the change tree based on csv line, pre-commit method, post-commit method
+
+    """
+    pre_method = parse_pre_commit_method_def(line)
+    post_method = parse_post_commit_method_def(line)
+    pre_path, post_path = get_dst_path(pre_method), get_dst_path(post_method)
+
+    cache = StageCache(CONFIG.pipeline_cache_root, get_row_key(line))
+
+    if uses_git_backend(post_method):
+        fetch_params = {"source": "git", "pre": [pre_method.sha.strip(), pre_method.filepath],
+                        "post": [post_method.sha.strip(), post_method.filepath]}
+        is_fetched = True
+    else:
+        fetch_params = {"pre_url": pre_method.url, "post_url": post_method.url}
+        is_fetched = pre_path.exists() and post_path.exists()
+
+    contents = None
+    fetch = cache.lookup("fetch", fetch_params, [])
+    if fetch is None or not is_fetched:
+        contents = read_commit_files(pre_method, post_method, ledger)
+        fetch = cache.store("fetch", fetch_params, [], hash_json([hash_bytes(content) for content in contents]))
+
+    # Parsed trees can not be persisted, so parse and locate are only redone when sampling has to be redone
+    parse_params = {"language": "java"}
+    locate_params = {"pre_pos": [pre_method.line, pre_method.col], "post_pos": [post_method.line, post_method.col]}
+    sample_params = {"max_root_paths": CONFIG.max_root_paths, "strategy": CONFIG.sampling_strategy,
+                     "n_context_leaves": CONFIG.n_context_leaves, "root_paths_per_node": CONFIG.root_paths_per_node,
+                     "min_root_paths": CONFIG.min_root_paths}
+    # Rows exceeding a tightened budget must fail instead of being served from the cache
+    sample_params["budgets"] = {"max_file_size": CONFIG.max_file_size, "max_method_nodes": CONFIG.max_method_nodes,
+                                "parse_timeout": CONFIG.parse_timeout, "sample_timeout": CONFIG.sample_timeout,
+                                "build_timeout": CONFIG.build_timeout}
+    if CONFIG.extract_path_contexts:
+        sample_params["path_contexts"] = {"max_path_length": CONFIG.max_path_length,
+                                          "max_path_width": CONFIG.max_path_width,
+                                          "max_path_contexts": CONFIG.max_path_contexts, "with_strings": True}
+
+    parse = cache.lookup("parse", parse_params, [fetch.output_hash])
+    locate = cache.lookup("locate", locate_params, [parse.output_hash]) if parse else None
+    sample = cache.lookup("sample", sample_params, [locate.output_hash]) if locate else None
+
+    if sample is None:
+        if contents is None:
+            contents = read_commit_files(pre_method, post_method, ledger)
+        pre_file_tree, post_file_tree, changed_ranges = parse_commit_files(*contents)
+        parse = cache.store("parse", parse_params, [fetch.output_hash])
+
+        if locate is None:
+            pre_tree = pre_file_tree.get_method_by_pos(pre_method.line, pre_method.col)
+            post_tree = post_file_tree.get_method_by_pos(post_method.line, post_method.col)
+        else:
+            pre_tree = pre_file_tree.get_method_by_byte_range(*locate.value["pre"])
+            post_tree = post_file_tree.get_method_by_byte_range(*locate.value["post"])
+
+        if pre_tree is None or post_tree is None:
+            cache.save()
+            check_methods_found(pre_tree, post_tree, post_method)
+
+        if locate is None:
+            method_ranges = {
+                "pre": [pre_tree.root.raw_node.start_byte, pre_tree.root.raw_node.end_byte],
+                "post": [post_tree.root.raw_node.start_byte, post_tree.root.raw_node.end_byte],
+            }
+            locate = cache.store("locate", locate_params, [parse.output_hash], value=method_ranges)
+
+        ch_tree = build_chtree(pre_tree, post_tree, changed_ranges)
+        sample = cache.store("sample", sample_params, [locate.output_hash],
+                             output=(ch_tree.before_paths, ch_tree.after_paths, ch_tree.path_contexts,
+                                     ch_tree.method_sizes, ch_tree.path_context_strings))
+    else:
+        ch_tree = ChangeTree.from_root_paths(*cache.load_output(sample))
+
+    build = cache.lookup("build", {}, [sample.output_hash]) or cache.store("build", {}, [sample.output_hash])
+
+    save_params = {"dst_path": str(get_chtree_path(post_method, chtree_root))}
+    if cache.lookup("save", save_params, [build.output_hash]) is None or not Path(save_params["dst_path"]).exists():
+        dst_path = save_chtree(ch_tree, post_method, chtree_root)
+        cache.store("save", save_params, [build.output_hash], hash_file(dst_path))
+
+    cache.save()
+
+    return ch_tree, pre_method, post_method
+
+
+def process_csv_line(line: str, chtree_root: Path | str | None = None, ledger: FailureLedger | None = None) \
+        -> tuple[ChangeTree, CommitMethodDefinition, CommitMethodDefinition]:
+    """
+    Parse a csv line and save its change tree, through the stage cache if it is configured
+
+    Args:
+        line: The line to process
+        chtree_root: The change tree save root, defaults to summer23_chtree_root
+        ledger: Failure ledger used for the downloads
+
+    Returns: Tuple of: the change tree based on csv line, pre-commit method, post-commit method
+
+    """
+    if CONFIG.pipeline_cache_root:
+        return parse_csv_line_cached(line, chtree_root, ledger)
+
+    ch_tree, pre_method, post_method = parse_csv_line(line, ledger)
+    save_chtree(ch_tree, post_method, chtree_root)
+
+    return ch_tree, pre_method, post_method
+
+
+def get_shard_key(line: str) -> str:
+    """
+    Get the key deciding the shard of a csv line in distributed processing, rows of the same commit share a shard
+
+    Args:
+        line: The csv line
+
+    Returns: The "repo,sha" key of the post commit state
+
+    """
+    post_method = parse_post_commit_method_def(line)
+    return f"{post_method.repo},{post_method.sha.strip()}"
+
+
+def process_shard_row(line: str, output_root: Path) -> None:
+    """
+    Row processor for pipeline.distributed, saves the change tree of a csv line under the shard output root
+    """
+    process_csv_line(line, output_root)
+
+
+def fetch_row(line: str, ledger: FailureLedger | None = None) -> tuple[str, bytes, bytes]:
+    """
+    Fetch stage of the pipelined processing: read the pre and post files of a csv line
+
+    Returns: Tuple of: the line, pre file content, post file content
+
+    """
+    return line, *read_commit_files(parse_pre_commit_method_def(line), parse_post_commit_method_def(line), ledger)
+
+
+def build_row(fetched_row: tuple[str, bytes, bytes]) -> tuple[ChangeTree, CommitMethodDefinition]:
+    """
+    Build stage of the pipelined processing: parse the files, locate the methods and build the change tree. Parsing
+    and building are one stage because the parsed trees can not be passed between processes.
+
+    Returns: Tuple of: the change tree, post-commit method
+
+    """
+    line, pre_content, post_content = fetched_row
+    pre_method, post_method = parse_pre_commit_method_def(line), parse_post_commit_method_def(line)
+
+    return chtree_from_contents(pre_content, post_content, pre_method, post_method), post_method
+
+
+def persist_row(built_row: tuple[ChangeTree, CommitMethodDefinition]) -> tuple[ChangeTree, CommitMethodDefinition]:
+    """
+    Persist stage of the pipelined processing: save the change tree
+
+    Returns: Tuple of: the change tree, post-commit method
+
+    """
+    ch_tree, post_method = built_row
+    save_chtree(ch_tree, post_method)
+
+    return built_row
+
+
+def parse_csv_pipelined(csv_lines: list[str], ledger: FailureLedger | None = None, catalog: Catalog | None = None,
+                        accountant: MemoryAccountant | None = None) -> None:
+    """
+    Parse the csv lines with the fetch, build and save stages overlapping: fetching and saving run on threads, building
+    on a process pool. The stage cache is not used.
+
+    Args:
+        csv_lines: The csv lines to parse
+        ledger: Failure ledger of the rows and the downloads
+        catalog: Catalog to add the processed methods to
+        accountant: Memory accountant checking the memory limit after every row, the parsing stops if it is exceeded.
+            The build processes are not accounted and do not trace
+    """
+    pipeline = StagedPipeline([
+        Stage("fetch", partial(fetch_row, ledger=ledger), CONFIG.fetch_workers,
+              queue_size=CONFIG.pipeline_queue_size),
+        Stage("build", build_row, CONFIG.build_workers or os.cpu_count(), use_processes=True,
+              queue_size=CONFIG.pipeline_queue_size, initializer=stop_tracing),
+        Stage("persist", persist_row, CONFIG.persist_workers, queue_size=CONFIG.pipeline_queue_size),
+    ])
+
+    # Set when the memory limit is exceeded: no more lines are fed, the lines already in the pipeline are finished
+    stopping = threading.Event()
+
+    def iter_rows():
+        for idx, line in enumerate(csv_lines):
+            if stopping.is_set():
+                return
+            if ledger and (known_failure := ledger.should_skip(get_row_key(line))):
+                logger.info(f"Skipping line idx '{idx}' with known {known_failure.category} failure "
+                            f"({known_failure.attempts} attempts): {known_failure.message}")
+                pbar.update(1)
+                continue
+            yield idx, line
+
+    n_fail = 0
+    with tqdm(total=len(csv_lines), desc="Processing dataset") as pbar:
+        for result in pipeline.run(iter_rows()):
+            row_key = get_row_key(csv_lines[result.key])
+            pbar.update(1)
+
+            if result.error is not None:
+                logger.error(f"Error in {result.failed_stage} of line idx '{result.key}': "
+                             f"{type(result.error).__name__}: {result.error}")
+                n_fail += 1
+                pbar.set_postfix({"Fails": n_fail})
+                if ledger:
+                    ledger.record(row_key, result.error)
+                continue
+
+            if ledger:
+                ledger.clear(row_key)
+            ch_tree, post_method = result.value
+            if catalog:
+                catalog.add(get_catalog_entry(csv_lines[result.key], ch_tree, post_method, result.stage_times))
+            logger.info(f"Generated ChangeTree for repo '{post_method.repo}', commit '{post_method.sha}', "
+                        f"file '{Path(post_method.filepath).name}', method '{post_method.identifier}")
+            if accountant and not stopping.is_set() and accountant.check_limit():
+                log_memory_limit_stop(result.key)
+                stopping.set()
+
+    logger.info(pipeline.get_report())
+
+
+def get_file_group_key(line: str) -> tuple[str, str, str, str, str]:
+    """
+    Get the key grouping the csv lines whose methods are in the same pre and post files
+
+    Returns: Tuple of: repo, pre-commit sha, pre-commit filepath, post-commit sha, post-commit filepath
+
+    """
+    pre_method, post_method = parse_pre_commit_method_def(line), parse_post_commit_method_def(line)
+    return post_method.repo, pre_method.sha.strip(), pre_method.filepath, post_method.sha.strip(), post_method.filepath
+
+
+def group_by_file(csv_lines: list[str]) -> list[list[int]]:
+    """
+    Group the indexes of the csv lines by their pre and post files (see get_file_group_key), the groups are in the
+    order of their first line
+    """
+    groups = {}
+    for idx, line in enumerate(csv_lines):
+        groups.setdefault(get_file_group_key(line), []).append(idx)
+
+    return list(groups.values())
+
+
+def process_file_group(lines: list[tuple[int, str]], ledger: FailureLedger | None = None) \
+        -> Iterator[tuple[int, ChangeTree | None, CommitMethodDefinition, Exception | None, float]]:
+    """
+    Build and save the change trees of csv lines sharing their pre and post files: the files are read and parsed once
+    and the methods of all lines are located in a single traversal of each file tree. The files and trees are released
+    when the generator is exhausted.
+
+    Args:
+        lines: (index, line) tuples of the group
+        ledger: Failure ledger used for the downloads
+
+    Returns: Iterator of (index, change tree, post-commit method, error, seconds spent) tuples in the order of the lines,
+        error is set and the change tree is None if the line failed
+
+    """
+    methods = [(idx, parse_pre_commit_method_def(line), parse_post_commit_method_def(line)) for idx, line in lines]
+
+    start = time.perf_counter()
+    try:
+        _, pre_method, post_method = methods[0]
+        pre_file_tree, post_file_tree, changed_ranges = \
+            parse_commit_files(*read_commit_files(pre_method, post_method, ledger))
+        pre_method_index, post_method_index = pre_file_tree.get_method_index(), post_file_tree.get_method_index()
+    except Exception as ex:
+        for idx, _, post_method in methods:
+            yield idx, None, post_method, ex, 0
+        return
+    # Reading and parsing the files is shared by the lines of the group
+    shared_time = (time.perf_counter() - start) / len(methods)
+
+    for idx, pre_method, post_method in methods:
+        start = time.perf_counter()
+        try:
+            pre_tree = get_method_from_index(pre_method_index, pre_method.line)
+            post_tree = get_method_from_index(post_method_index, post_method.line)
+            check_methods_found(pre_tree, post_tree, post_method)
+
+            ch_tree = build_chtree(pre_tree, post_tree, changed_ranges)
+            save_chtree(ch_tree, post_method)
+        except Exception as ex:
+            yield idx, None, post_method, ex, 0
+            continue
+
+        yield idx, ch_tree, post_method, None, shared_time + time.perf_counter() - start
+
+
+def parse_csv_grouped(csv_lines: list[str], ledger: FailureLedger | None = None, catalog: Catalog | None = None,
+                      accountant: MemoryAccountant | None = None) -> None:
+    """
+    Parse the csv lines grouped by their pre and post files, so a file pair is only read and parsed once for all the
+    methods changed in it. The stage cache is not used.
+
+    Args:
+        csv_lines: The csv lines to parse
+        ledger: Failure ledger of the rows and the downloads
+        catalog: Catalog to add the processed methods to
+        accountant: Memory accountant checking the memory limit after every group, the parsing stops if it is exceeded
+    """
+    groups = group_by_file(csv_lines)
+    logger.info(f"Parsing {len(csv_lines)} lines in {len(groups)} file groups")
+
+    n_fail = 0
+    n_skipped = 0
+    with tqdm(total=len(csv_lines), desc="Processing dataset") as pbar:
+        for group in groups:
+            lines = []
+            for idx in group:
+                if ledger and (known_failure := ledger.should_skip(get_row_key(csv_lines[idx]))):
+                    logger.info(f"Skipping line idx '{idx}' with known {known_failure.category} failure "
+                                f"({known_failure.attempts} attempts): {known_failure.message}")
+                    n_skipped += 1
+                    pbar.update(1)
+                else:
+                    lines.append((idx, csv_lines[idx]))
+            if not lines:
+                continue
+
+            for idx, ch_tree, post_method, error, process_time in process_file_group(lines, ledger):
+                row_key = get_row_key(csv_lines[idx])
+                pbar.update(1)
+                try:
+                    if error is not None:
+                        raise error
+
+                    start = time.perf_counter()
+                    with time_limit(CONFIG.build_timeout, "build_timeout"), track_memory("create"):
+                        ch_tree.create_after()
+                    timings = {"process": process_time, "create": time.perf_counter() - start}
+                except Exception as ex:
+                    logger.error(f"Error in line idx '{idx}': {type(ex).__name__}: {ex}")
+                    n_fail += 1
+                    pbar.set_postfix({"Fails": n_fail, "Skipped": n_skipped})
+                    if ledger:
+                        ledger.record(row_key, ex)
+                    continue
+
+                if ledger:
+                    ledger.clear(row_key)
+                if catalog:
+                    catalog.add(get_catalog_entry(csv_lines[idx], ch_tree, post_method, timings))
+                logger.info(f"Generated ChangeTree for repo '{post_method.repo}', commit '{post_method.sha}', "
+                            f"file '{Path(post_method.filepath).name}', method '{post_method.identifier}")
+                if accountant and CONFIG.memory_limit_mb:
+                    ch_tree.drop_paths()
+
+            if accountant and accountant.check_limit():
+                log_memory_limit_stop(idx)
+                break
+
+
+def log_memory_limit_stop(idx: int) -> None:
+    resume_hint = "rerun with skip_cataloged to process the remaining lines" if CONFIG.catalog_path \
+        else "set catalog_path and skip_cataloged to be able to resume"
+    logger.error(f"Stopping after line idx '{idx}': the RSS is above the memory limit of {CONFIG.memory_limit_mb} MB "
+                 f"even after flushing, {resume_hint}")
+
+
+def close_accountant(accountant: MemoryAccountant | None) -> None:
+    if accountant:
+        logger.info(f"Memory report:\n{accountant.get_report()}")
+        accountant.close()
+        set_accountant(None)
+
 
 def parse_csv() -> None:
     """
     Parse the summer23 (commit fixes) dataset
     """
+    setup_logging()
     logger.info(f"Start parsing CSV from dataset '{CONFIG.summer23_dataset_path}'")
     csv_lines = get_lines_from_file(CONFIG.summer23_dataset_path)[1:]
+    ledger = FailureLedger(CONFIG.failure_ledger_path) if CONFIG.failure_ledger_path else None
+    catalog = Catalog(CONFIG.catalog_path) if CONFIG.catalog_path else None
+    if catalog and CONFIG.skip_cataloged:
+        cataloged_keys = catalog.get_row_keys()
+        n_lines = len(csv_lines)
+        csv_lines = [line for line in csv_lines if get_row_key(line) not in cataloged_keys]
+        logger.info(f"Skipping {n_lines - len(csv_lines)} lines already in the catalog")
+
+    accountant = None
+    if CONFIG.memory_accounting or CONFIG.memory_limit_mb:
+        accountant = MemoryAccountant(CONFIG.memory_limit_mb, CONFIG.memory_accounting,
+                                      CONFIG.memory_snapshot_interval)
+        set_accountant(accountant)
+        if catalog:
+            accountant.register_flush(catalog.flush)
+
+    if CONFIG.pipelined or CONFIG.group_by_file:
+        if CONFIG.pipelined:
+            parse_csv_pipelined(csv_lines, ledger, catalog, accountant)
+        else:
+            parse_csv_grouped(csv_lines, ledger, catalog, accountant)
+        if catalog:
+            catalog.close()
+        close_accountant(accountant)
+        return
 
     n_fail = 0
+    n_skipped = 0
     with tqdm(total=len(csv_lines), desc="Processing dataset") as pbar:
         for idx, line in tqdm(enumerate(csv_lines)):
             logger.info(f"Parsing and getting data for line idx '{idx}'")
+            row_key = get_row_key(line)
             try:
-                ch_tree, pre_method, post_method = parse_csv_line(line)
+                if ledger and (known_failure := ledger.should_skip(row_key)):
+                    logger.info(f"Skipping line idx '{idx}' with known {known_failure.category} failure "
+                                f"({known_failure.attempts} attempts): {known_failure.message}")
+                    n_skipped += 1
+                    continue
+
+                start = time.perf_counter()
+                ch_tree, pre_method, post_method = process_csv_line(line, ledger=ledger)
+                timings = {"process": time.perf_counter() - start}
+
+                start = time.perf_counter()
+                with time_limit(CONFIG.build_timeout, "build_timeout"), track_memory("create"):
+                    ch_tree.create_after()
+                timings["create"] = time.perf_counter() - start
             except requests.exceptions.HTTPError as ex:
-                logger.error("HTTP Error: ", ex)
+                logger.error(f"HTTP Error: {ex}")
                 n_fail += 1
+                if ledger:
+                    ledger.record(row_key, ex)
                 continue
             except Exception as ex:
-                logger.error("Error: ", ex)
+                logger.error(f"Error: {type(ex).__name__}: {ex}")
                 n_fail += 1
+                if ledger:
+                    ledger.record(row_key, ex)
                 continue
             finally:
                 pbar.update(1)
-                pbar.set_postfix({"Fails": n_fail})
+                pbar.set_postfix({"Fails": n_fail, "Skipped": n_skipped})
+
+            if ledger:
+                ledger.clear(row_key)
+            if catalog:
+                catalog.add(get_catalog_entry(line, ch_tree, post_method, timings))
 
-            save_chtree(ch_tree, post_method)
-            ch_tree.create_after()
             dump_tree_to_png(ch_tree, "F:/work/kutatas/datasets/tmp/hello.png")
             logger.info(f"Generated ChangeTree for repo '{post_method.repo}', commit '{post_method.sha}', "
                         f"file '{Path(post_method.filepath).name}', method '{post_method.identifier}")
 
+            if accountant:
+                if CONFIG.memory_limit_mb:
+                    ch_tree.drop_paths()
+                if accountant.check_limit():
+                    log_memory_limit_stop(idx)
+                    break
+
+    if catalog:
+        catalog.close()
+    close_accountant(accountant)
     logger.info(f"Start parsing CSV from dataset '{CONFIG.summer23_dataset_path}'")
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+from pathlib import Path
+import argparse
+import hashlib
+import pickle
+
+import numpy as np
+
+from path_context.flat_tree import FlatTree
+from tree_sitter_wrapper.tree import TreeSitterTree
+
+
+# Odd multiplier of the polynomial hashes of the node types on the paths
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def get_id(text: str) -> int:
+    """Get a stable 63 bit id of a token or path string, so ids agree between processes and runs."""
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little") >> 1
+
+
+class PathContextExtractor:
+    """
+    Extracts code2vec style path contexts: (start leaf token, AST path, end leaf token) triples for pairs of leaves.
+    The paths are encoded as strings of the node types, going up ("^") from the start leaf to the lowest common
+    ancestor and down ("v") to the end leaf. Tokens and paths are integer encoded with get_id.
+
+    """
+
+    def __init__(self, max_path_length: int = 8, max_path_width: int = 2, max_contexts: int = 200,
+                 max_candidate_pairs: int = 1 << 21, named_leaves_only: bool = True, seed: int | None = None):
+        """
+        Args:
+            max_path_length: Maximum number of edges of a path
+            max_path_width: Maximum difference of the sibling indices of the children of the lowest common ancestor
+                on the path
+            max_contexts: Maximum number of contexts to keep, randomly sampled if there are more
+            max_candidate_pairs: If a tree has more leaf pairs under common ancestors within the path length and width
+                limits than this, only this many random pairs are considered
+            named_leaves_only: Whether to skip punctuation and keyword leaves
+            seed: Random seed for the sampling
+        """
+        self.max_path_length = max_path_length
+        self.max_path_width = max_path_width
+        self.max_contexts = max_contexts
+        self.max_candidate_pairs = max_candidate_pairs
+        self.named_leaves_only = named_leaves_only
+        self.generator = np.random.default_rng(seed)
+        self.strings: dict[int, str] = {}
+
+    def get_candidate_pairs(self, lo: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Expand ranges of pairs: the i-th range pairs its owner i with lo[i], ..., lo[i] + counts[i] - 1. If there are
+        more pairs than max_candidate_pairs, a uniform random sample of them is expanded.
+
+        Returns: Tuple of: owners, partners
+
+        """
+        bounds = np.cumsum(counts)
+        n_pairs = int(bounds[-1]) if len(bounds) else 0
+        if n_pairs <= self.max_candidate_pairs:
+            pair_idxs = np.arange(n_pairs)
+        else:
+            pair_idxs = np.sort(self.generator.choice(n_pairs, self.max_candidate_pairs, replace=False))
+
+        owners = np.searchsorted(bounds, pair_idxs, side="right")
+        return owners, lo[owners] + pair_idxs - (bounds[owners] - counts[owners])
+
+    def get_valid_pairs(self, tree: FlatTree) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get the leaf pairs whose path satisfies the length and width limits, in the order of their start and end
+        leaves. Instead of testing every pair of leaves, the ancestors of the leaves up to max_path_length - 1 edges
+        above them are joined on the ancestor: two leaves form a pair under a common ancestor if the children of the
+        ancestor on their paths are at most max_path_width siblings apart.
+
+        Returns: Tuple of: start leaves, end leaves, their lowest common ancestors
+
+        """
+        leaves = tree.get_leaves(self.named_leaves_only)
+        empty = np.empty(0, dtype=np.int64)
+        if len(leaves) < 2:
+            return empty, empty, empty
+
+        # Leaf, distance to the ancestor, ancestor and the child of the ancestor on the path of every leaf
+        record_leaves, record_lengths, record_ancestors, record_children = [], [], [], []
+        path_leaves, nodes = leaves, leaves
+        for length in range(1, self.max_path_length):
+            ancestors = tree.parents[nodes]
+            has_ancestor = ancestors >= 0
+            path_leaves, nodes, ancestors = path_leaves[has_ancestor], nodes[has_ancestor], ancestors[has_ancestor]
+            record_leaves.append(path_leaves)
+            record_lengths.append(np.full(len(nodes), length))
+            record_ancestors.append(ancestors)
+            record_children.append(nodes)
+            nodes = ancestors
+
+        if self.max_path_length < 2:
+            return empty, empty, empty
+        record_leaves, record_lengths, record_ancestors, record_children = map(np.concatenate, (
+            record_leaves, record_lengths, record_ancestors, record_children))
+
+        # Records sorted by (ancestor, sibling index of the child), the partners of a record under the same ancestor
+        # are the records whose child is 1 to max_path_width siblings to the right
+        key_stride = int(tree.sibling_idxs.max()) + self.max_path_width + 1
+        keys = record_ancestors * key_stride + tree.sibling_idxs[record_children]
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        lo = np.concatenate([np.searchsorted(keys, keys + width, side="left")
+                             for width in range(1, self.max_path_width + 1)])
+        hi = np.concatenate([np.searchsorted(keys, keys + width, side="right")
+                             for width in range(1, self.max_path_width + 1)])
+        owners, partners = self.get_candidate_pairs(lo, hi - lo)
+        firsts, seconds = order[owners % len(keys)], order[partners]
+
+        is_short = record_lengths[firsts] + record_lengths[seconds] <= self.max_path_length
+        firsts, seconds = firsts[is_short], seconds[is_short]
+        starts, ends, lcas = record_leaves[firsts], record_leaves[seconds], record_ancestors[firsts]
+
+        # Nodes are numbered in DFS order, so this is the order of the leaves in the source
+        pair_order = np.lexsort((ends, starts))
+        return starts[pair_order], ends[pair_order], lcas[pair_order]
+
+    def encode(self, text: str) -> int:
+        text_id = get_id(text)
+        self.strings[text_id] = text
+        return text_id
+
+    def get_contexts(self, tree: FlatTree, starts: np.ndarray, ends: np.ndarray, lcas: np.ndarray) -> np.ndarray:
+        contexts = np.empty((len(starts), 3), dtype=np.int64)
+
+        for idx, (start, end, lca) in enumerate(zip(starts.tolist(), ends.tolist(), lcas.tolist())):
+            up, down = tree.get_path(start, end, lca)
+            path = " ^ ".join(tree.types[node] for node in up)
+            if down:
+                path += " v " + " v ".join(tree.types[node] for node in down)
+
+            contexts[idx] = (self.encode(get_leaf_token(tree, start)), self.encode(path),
+                             self.encode(get_leaf_token(tree, end)))
+
+        return contexts
+
+    def get_context_keys(self, tree: FlatTree, starts: np.ndarray, ends: np.ndarray, lcas: np.ndarray) -> np.ndarray:
+        """
+        Get a 64 bit key of the context of every leaf pair without building the path strings: the hashes of the
+        node types going up from the start leaf and from the end leaf to the lowest common ancestor, combined with the
+        ids of the leaf tokens. Equal contexts of different trees get equal keys.
+        """
+        type_ids = {node_type: get_id(node_type) for node_type in set(tree.types)}
+        type_keys = np.array([type_ids[node_type] for node_type in tree.types], dtype=np.uint64)
+        leaves = np.unique(np.concatenate([starts, ends]))
+        token_keys = np.zeros(len(tree), dtype=np.uint64)
+        token_keys[leaves] = [get_id(get_leaf_token(tree, leaf)) for leaf in leaves.tolist()]
+
+        keys = []
+        for nodes in (starts, ends):
+            lengths = tree.depths[nodes] - tree.depths[lcas]
+            side_keys = lengths.astype(np.uint64)
+            # Includes the lca on both sides, which does not change the equality of the keys
+            for distance in range(self.max_path_length + 1):
+                side_keys = np.where(distance <= lengths, side_keys * HASH_MULTIPLIER + type_keys[nodes], side_keys)
+                nodes = np.where(distance < lengths, tree.parents[nodes], nodes)
+            keys.append(side_keys)
+
+        up_keys, down_keys = keys
+        return ((up_keys * HASH_MULTIPLIER + down_keys) * HASH_MULTIPLIER + token_keys[starts]) * HASH_MULTIPLIER + \
+            token_keys[ends]
+
+    def extract(self, tree: FlatTree | TreeSitterTree) -> np.ndarray:
+        """
+        Extract the path contexts of a tree
+
+        Args:
+            tree: The tree, e.g. a method
+
+        Returns: Array of (start token id, path id, end token id) rows
+
+        """
+        if isinstance(tree, TreeSitterTree):
+            tree = FlatTree(tree.root.raw_node)
+
+        starts, ends, lcas = self.get_valid_pairs(tree)
+        if len(starts) > (self.max_contexts or len(starts)):
+            keep = np.sort(self.generator.choice(len(starts), self.max_contexts, replace=False))
+            starts, ends, lcas = starts[keep], ends[keep], lcas[keep]
+
+        return self.get_contexts(tree, starts, ends, lcas)
+
+    def extract_changed(self, before_tree: FlatTree | TreeSitterTree, after_tree: FlatTree | TreeSitterTree) \
+            -> tuple[np.ndarray, np.ndarray]:
+        """
+        Extract the path contexts that are present in only one of the states of a code change. The valid leaf pairs of
+        both trees are compared by their context keys (see get_context_keys), so unchanged contexts cancel out; only
+        the sampled pairs of the remaining ones are decoded into contexts.
+
+        Args:
+            before_tree: The tree before the change
+            after_tree: The tree after the change
+
+        Returns: Tuple of: contexts only in the before tree, contexts only in the after tree
+
+        """
+        trees = [FlatTree(tree.root.raw_node) if isinstance(tree, TreeSitterTree) else tree
+                 for tree in (before_tree, after_tree)]
+        pairs = [self.get_valid_pairs(tree) for tree in trees]
+        keys = [self.get_context_keys(tree, *tree_pairs) for tree, tree_pairs in zip(trees, pairs)]
+
+        changed_contexts = []
+        for tree, (starts, ends, lcas), own_keys, other_keys in zip(trees, pairs, keys, keys[::-1]):
+            keep = np.flatnonzero(~np.isin(own_keys, other_keys))
+            if self.max_contexts is not None and len(keep) > self.max_contexts:
+                keep = np.sort(self.generator.choice(keep, self.max_contexts, replace=False))
+            changed_contexts.append(self.get_contexts(tree, starts[keep], ends[keep], lcas[keep]))
+
+        return changed_contexts[0], changed_contexts[1]
+
+    def pop_strings(self) -> dict[int, str]:
+        """Get and forget the id -> token/path mapping of everything encoded since the last call."""
+        strings, self.strings = self.strings, {}
+        return strings
+
+    def save_strings(self, path: Path | str) -> None:
+        """Save the id -> token/path mapping of everything encoded so far, appending to the file (tab separated)."""
+        save_strings(self.pop_strings(), path)
+
+
+def get_leaf_token(tree: FlatTree, node: int) -> str:
+    return tree.raw_nodes[node].text.decode(encoding="utf-8", errors="ignore")
+
+
+def save_strings(strings: dict[int, str], path: Path | str) -> None:
+    """Append an id -> token/path mapping to a tab separated file."""
+    with Path(path).open("a", encoding="utf-8") as fp:
+        for text_id, text in strings.items():
+            fp.write(f"{text_id}\t{text.encode('unicode_escape').decode()}\n")
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Collect the path context vocabulary of saved change trees")
+    arg_parser.add_argument("chtree_root", help="Directory of the pickled change trees")
+    arg_parser.add_argument("output", help="Where to save the id -> token/path mapping (tab separated)")
+    args = arg_parser.parse_args()
+
+    strings = {}
+    for chtree_path in Path(args.chtree_root).rglob("*.pkl"):
+        with chtree_path.open("rb") as fp:
+            strings.update(getattr(pickle.load(fp), "path_context_strings", None) or {})
+
+    Path(args.output).unlink(missing_ok=True)
+    save_strings(strings, args.output)
+    print(f"Saved {len(strings)} tokens and paths to '{args.output}'")
+
+
+if __name__ == '__main__':
+    main()
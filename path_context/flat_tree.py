@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import numpy as np
+from tree_sitter import Node as RawNode
+
+
+class FlatTree:
+    """
+    Array representation of a TreeSitter (sub)tree: the type, parent, depth and sibling index of every node, numbered
+    in DFS order.
+
+    """
+
+    def __init__(self, root: RawNode):
+        self.types: list[str] = []
+        self.raw_nodes: list[RawNode] = []
+        parents: list[int] = []
+        depths: list[int] = []
+        sibling_idxs: list[int] = []
+
+        def add_node(raw_node: RawNode, parent: int, sibling_idx: int) -> int:
+            self.types.append(raw_node.type)
+            self.raw_nodes.append(raw_node)
+            parents.append(parent)
+            depths.append(depths[parent] + 1 if parent >= 0 else 0)
+            sibling_idxs.append(sibling_idx)
+            return len(self.types) - 1
+
+        add_node(root, -1, 0)
+        stack = [(0, iter(enumerate(root.children)))]
+        while stack:
+            node_idx, children = stack[-1]
+            sibling_idx, child = next(children, (None, None))
+            if child is None:
+                stack.pop()
+                continue
+
+            child_idx = add_node(child, node_idx, sibling_idx)
+            stack.append((child_idx, iter(enumerate(child.children))))
+
+        self.parents = np.array(parents, dtype=np.int64)
+        self.depths = np.array(depths, dtype=np.int64)
+        self.sibling_idxs = np.array(sibling_idxs, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def get_path(self, node_a: int, node_b: int, lca: int) -> tuple[list[int], list[int]]:
+        """
+        Get the nodes of the path between two nodes
+
+        Returns: Tuple of: nodes from node_a up to the lca (inclusive), nodes from below the lca down to node_b
+
+        """
+        up = [node_a]
+        while up[-1] != lca:
+            up.append(int(self.parents[up[-1]]))
+
+        down = [node_b]
+        while down[-1] != lca:
+            down.append(int(self.parents[down[-1]]))
+        down.pop()
+
+        return up, down[::-1]
+
+    def get_leaves(self, named_only: bool = True) -> np.ndarray:
+        """Get the leaves in source order, optionally only the named ones (no punctuation and keywords)."""
+        has_children = np.zeros(len(self.types), dtype=bool)
+        has_children[self.parents[self.parents >= 0]] = True
+
+        return np.array([idx for idx in np.flatnonzero(~has_children)
+                         if not named_only or self.raw_nodes[idx].is_named], dtype=np.int64)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from typing import Iterator
+import signal
+import threading
+import time
+
+from pipeline.failure_ledger import BudgetExceededError
+
+
+def check_file_sizes(contents: tuple[bytes, ...], max_file_size: int | None) -> None:
+    """
+    Check the sizes of the files of a row before parsing them
+
+    Args:
+        contents: The file contents
+        max_file_size: Maximum size of a file in bytes, None for no limit
+    """
+    if max_file_size is None:
+        return
+
+    for content in contents:
+        if len(content) > max_file_size:
+            raise BudgetExceededError("file_size", f"File of {len(content)} bytes is larger than {max_file_size}")
+
+
+def check_method_nodes(n_nodes: int, max_method_nodes: int | None) -> None:
+    """
+    Check the size of a located method before sampling it
+
+    Args:
+        n_nodes: The number of AST nodes of the method
+        max_method_nodes: Maximum number of AST nodes of a method, None for no limit
+    """
+    if max_method_nodes is not None and n_nodes > max_method_nodes:
+        raise BudgetExceededError("method_nodes", f"Method of {n_nodes} nodes is larger than {max_method_nodes}")
+
+
+def get_root_path_budget(n_nodes: int, max_root_paths: int, root_paths_per_node: float | None,
+                         min_root_paths: int) -> int:
+    """
+    Get the number of root paths to sample from a method, scaling with its size
+
+    Args:
+        n_nodes: The number of AST nodes of the method
+        max_root_paths: The number of root paths for the largest methods
+        root_paths_per_node: Root paths per AST node, None for always max_root_paths
+        min_root_paths: The number of root paths for the smallest methods
+
+    Returns: The number of root paths to sample
+
+    """
+    if root_paths_per_node is None:
+        return max_root_paths
+
+    return max(min(round(n_nodes * root_paths_per_node), max_root_paths), min(min_root_paths, max_root_paths))
+
+
+@contextmanager
+def time_limit(seconds: float | None, reason: str) -> Iterator[None]:
+    """
+    Limit the wall-clock time of a block. In the main thread the block is interrupted with SIGALRM when the time is up
+    (only between Python bytecodes, long C calls finish first). Elsewhere, e.g. on pipeline threads, the time can only
+    be checked once the block finished.
+
+    Args:
+        seconds: The time limit, None for no limit
+        reason: The reason of the BudgetExceededError raised if the time is up, e.g. "sample_timeout"
+    """
+    if not seconds:
+        yield
+        return
+
+    def on_alarm(*_) -> None:
+        raise BudgetExceededError(reason, f"Did not finish in {seconds}s")
+
+    use_alarm = hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    if time.perf_counter() - start > seconds:
+        on_alarm()
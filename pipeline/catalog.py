@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, astuple, fields
+from pathlib import Path
+import argparse
+import json
+import sqlite3
+import threading
+import time
+
+
+@dataclass
+class CatalogEntry:
+    """
+    A processed method. type_histogram maps node types to their number among the nodes of the changed root paths,
+    timings maps processing steps to seconds.
+    """
+    row_key: str
+    repo: str
+    sha: str
+    filepath: str
+    identifier: str
+    line: int
+    col: int
+    chtree_path: str
+    pre_nodes: int | None
+    post_nodes: int | None
+    before_paths: int
+    after_paths: int
+    changed_before_paths: int
+    changed_after_paths: int
+    changed_nodes: int
+    path_contexts: int | None
+    type_histogram: dict[str, int]
+    timings: dict[str, float]
+    processed_at: float
+
+    def to_row(self) -> tuple:
+        return tuple(json.dumps(value, sort_keys=True) if isinstance(value, dict) else value for value in astuple(self))
+
+
+COLUMNS = [field.name for field in fields(CatalogEntry)]
+
+INDEXED_COLUMNS = [("repo", "sha"), ("identifier",), ("filepath",), ("pre_nodes",), ("post_nodes",),
+                   ("changed_before_paths",), ("changed_after_paths",)]
+
+
+class Catalog:
+    """
+    SQLite catalog of the processed methods (one row per csv row), so subsets of the dataset can be selected without
+    loading the change trees, e.g. "SELECT chtree_path FROM methods WHERE repo = ? AND changed_after_paths > 10".
+    Entries are buffered and written batch_size at a time in one transaction.
+
+    """
+
+    def __init__(self, path: Path | str, batch_size: int = 500):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self.batch_size = batch_size
+        self.pending: list[CatalogEntry] = []
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS methods (
+                row_key TEXT PRIMARY KEY,
+                repo TEXT NOT NULL,
+                sha TEXT NOT NULL,
+                filepath TEXT NOT NULL,
+                identifier TEXT NOT NULL,
+                line INTEGER NOT NULL,
+                col INTEGER NOT NULL,
+                chtree_path TEXT NOT NULL,
+                pre_nodes INTEGER,
+                post_nodes INTEGER,
+                before_paths INTEGER NOT NULL,
+                after_paths INTEGER NOT NULL,
+                changed_before_paths INTEGER NOT NULL,
+                changed_after_paths INTEGER NOT NULL,
+                changed_nodes INTEGER NOT NULL,
+                path_contexts INTEGER,
+                type_histogram TEXT NOT NULL,
+                timings TEXT NOT NULL,
+                processed_at REAL NOT NULL
+            )
+        """)
+        for columns in INDEXED_COLUMNS:
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS idx_methods_{'_'.join(columns)} "
+                                    f"ON methods ({', '.join(columns)})")
+        self.connection.commit()
+
+    def add(self, entry: CatalogEntry) -> None:
+        """Add or replace the entry of a row, written with the next full batch."""
+        with self.lock:
+            self.pending.append(entry)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.pending:
+                return
+
+            with self.connection:
+                self.connection.executemany(
+                    f"INSERT OR REPLACE INTO methods ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                    [entry.to_row() for entry in self.pending])
+            self.pending.clear()
+
+    def get_row_keys(self) -> set[str]:
+        """Get the keys of the rows in the catalog, pending entries included."""
+        return {row["row_key"] for row in self.query("SELECT row_key FROM methods")}
+
+    def query(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        """Run a read query on the catalog, pending entries are written first."""
+        self.flush()
+        with self.lock:
+            self.connection.row_factory = sqlite3.Row
+            try:
+                return self.connection.execute(sql, params).fetchall()
+            finally:
+                self.connection.row_factory = None
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self) -> Catalog:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Query the catalog of the processed methods")
+    arg_parser.add_argument("catalog_path")
+    arg_parser.add_argument("sql", help='e.g. "SELECT chtree_path FROM methods WHERE changed_after_paths > 10"')
+    args = arg_parser.parse_args()
+
+    start = time.perf_counter()
+    with Catalog(args.catalog_path) as catalog:
+        rows = catalog.query(args.sql)
+
+    for row in rows:
+        print("\t".join(str(value) for value in row))
+    print(f"{len(rows)} rows in {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable, Iterator
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# A row processor gets a csv line and the output root of its shard and raises on failure
+RowProcessor = Callable[[str, Path], None]
+
+SHARDS_DIR = "shards"
+LEASES_DIR = "leases"
+OUTPUT_DIR = "output"
+STAGING_DIR = "staging"
+FAILURES_NAME = "failures.jsonl"
+
+
+def get_shard(key: str, n_shards: int) -> int:
+    """
+    Get the shard of a row key, independent of the machine and the Python hash seed
+
+    Args:
+        key: The row key, e.g. "repo,sha"
+        n_shards: The number of shards
+
+    Returns: The shard id
+
+    """
+    return int(hashlib.md5(key.encode()).hexdigest(), 16) % n_shards
+
+
+def plan_shards(lines: list[str], work_dir: Path | str, n_shards: int, get_key: Callable[[str], str]) -> None:
+    """
+    Split the rows into shard files in the work directory. Every shard file has one JSON object per row with its
+    index in the dataset and the csv line.
+
+    Args:
+        lines: The csv lines (without header)
+        work_dir: The shared work directory
+        n_shards: The number of shards
+        get_key: Function giving the sharding key of a line
+    """
+    shards_dir = Path(work_dir) / SHARDS_DIR
+    if shards_dir.exists():
+        raise FileExistsError(f"Work directory '{work_dir}' is already planned")
+
+    shard_rows = [[] for _ in range(n_shards)]
+    for idx, line in enumerate(lines):
+        shard_rows[get_shard(get_key(line), n_shards)].append({"idx": idx, "line": line})
+
+    tmp_dir = Path(work_dir) / f"{SHARDS_DIR}.tmp"
+    tmp_dir.mkdir(parents=True)
+    for shard_id, rows in enumerate(shard_rows):
+        with (tmp_dir / f"{shard_id}.jsonl").open("w") as fp:
+            fp.writelines(json.dumps(row) + "\n" for row in rows)
+
+    for dir_name in (LEASES_DIR, OUTPUT_DIR, STAGING_DIR):
+        (Path(work_dir) / dir_name).mkdir(exist_ok=True)
+    tmp_dir.rename(shards_dir)
+
+
+class ShardLease:
+    """
+    Exclusive claim of a worker on a shard, coordinated only through the shared filesystem. The lease file is created
+    atomically and its modification time is the heartbeat: a lease not touched for lease_timeout seconds is expired and
+    can be taken over by another worker. A background thread touches the lease and notices when it was lost. The age
+    of a lease is measured with the clock of the filesystem, so the clocks of the nodes do not have to agree.
+
+    """
+
+    def __init__(self, lease_path: Path, worker_id: str, lease_timeout: float, heartbeat_interval: float):
+        self.lease_path = lease_path
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.heartbeat_thread: threading.Thread | None = None
+
+    def try_acquire(self) -> bool:
+        """
+        Try to claim the shard. An expired lease is first moved away with an atomic rename, so only one of the workers
+        racing for it can remove it. If the moved lease turns out to be fresh (another worker took over the expired one
+        after it was checked), it is put back and the shard is left to its owner.
+
+        Returns: Whether the shard is claimed by this worker
+
+        """
+        try:
+            lease_mtime = self.lease_path.stat().st_mtime
+            if self.get_filesystem_time() - lease_mtime < self.lease_timeout:
+                return False
+            expired_path = self.lease_path.with_suffix(f".expired-{self.worker_id}")
+            self.lease_path.rename(expired_path)
+        except FileNotFoundError:
+            pass
+        else:
+            if self.get_filesystem_time() - expired_path.stat().st_mtime < self.lease_timeout:
+                try:
+                    # Linking fails instead of replacing a lease created since the rename
+                    os.link(expired_path, self.lease_path)
+                except FileExistsError:
+                    pass
+                finally:
+                    expired_path.unlink()
+                return False
+            expired_path.unlink()
+            logger.warning(f"Took over expired lease '{self.lease_path.name}'")
+
+        try:
+            fd = os.open(self.lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, "w") as fp:
+            fp.write(self.worker_id)
+
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return True
+
+    def get_filesystem_time(self) -> float:
+        """Get the current time of the clock that sets the modification times of the lease files."""
+        probe_path = self.lease_path.with_suffix(f".probe-{self.worker_id}")
+        probe_path.touch()
+        try:
+            return probe_path.stat().st_mtime
+        finally:
+            probe_path.unlink()
+
+    def is_owned(self) -> bool:
+        try:
+            return self.lease_path.read_text() == self.worker_id
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self) -> None:
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                if not self.is_owned():
+                    raise FileNotFoundError(self.lease_path)
+                os.utime(self.lease_path)
+            except FileNotFoundError:
+                self.lost.set()
+                return
+
+    def release(self) -> None:
+        self.stopped.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join()
+        if self.is_owned():
+            self.lease_path.unlink()
+
+
+class ShardQueue:
+    """
+    Work queue over the shards of a planned work directory. A shard is done when its output directory exists: the
+    results are written to a staging directory of the worker and renamed to the output directory when the shard is
+    finished. The rename is atomic and fails if the output already exists, so every shard is committed exactly once
+    even if a slow worker and the one that took over its expired lease both finish it.
+
+    """
+
+    def __init__(self, work_dir: Path | str, lease_timeout: float = 300, heartbeat_interval: float = 30):
+        self.work_dir = Path(work_dir)
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    @property
+    def shard_ids(self) -> list[int]:
+        return sorted(int(path.stem) for path in (self.work_dir / SHARDS_DIR).glob("*.jsonl"))
+
+    def get_output_dir(self, shard_id: int) -> Path:
+        return self.work_dir / OUTPUT_DIR / str(shard_id)
+
+    def is_done(self, shard_id: int) -> bool:
+        return self.get_output_dir(shard_id).exists()
+
+    def iter_rows(self, shard_id: int) -> Iterator[dict]:
+        with (self.work_dir / SHARDS_DIR / f"{shard_id}.jsonl").open() as fp:
+            for row_line in fp:
+                yield json.loads(row_line)
+
+    def claim(self) -> tuple[int, ShardLease] | None:
+        """
+        Claim a shard that is neither done nor leased by a live worker
+
+        Returns: Tuple of: shard id, lease; or None if there is nothing left to claim
+
+        """
+        for shard_id in self.shard_ids:
+            if self.is_done(shard_id):
+                continue
+
+            lease = ShardLease(self.work_dir / LEASES_DIR / f"{shard_id}.lease", self.worker_id, self.lease_timeout,
+                               self.heartbeat_interval)
+            if lease.try_acquire():
+                if not self.is_done(shard_id):
+                    return shard_id, lease
+                lease.release()
+
+        return None
+
+    def get_pending(self) -> list[int]:
+        return [shard_id for shard_id in self.shard_ids if not self.is_done(shard_id)]
+
+    def process_shard(self, shard_id: int, lease: ShardLease, process_row: RowProcessor) -> bool:
+        """
+        Process the rows of a claimed shard and commit its results
+
+        Args:
+            shard_id: The claimed shard
+            lease: The lease of the shard
+            process_row: The row processor
+
+        Returns: Whether the results of this worker were committed
+
+        """
+        staging_dir = self.work_dir / STAGING_DIR / f"{shard_id}-{self.worker_id}"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.mkdir(parents=True)
+
+        with (staging_dir / FAILURES_NAME).open("w") as failures_fp:
+            for row in self.iter_rows(shard_id):
+                if lease.lost.is_set():
+                    logger.warning(f"Lost lease of shard {shard_id}, abandoning it")
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    return False
+
+                try:
+                    process_row(row["line"], staging_dir)
+                except Exception as ex:
+                    failure = {"idx": row["idx"], "error": type(ex).__name__, "message": str(ex),
+                               "traceback": traceback.format_exc(), "worker": self.worker_id}
+                    failures_fp.write(json.dumps(failure) + "\n")
+
+        try:
+            staging_dir.rename(self.get_output_dir(shard_id))
+        except OSError:
+            logger.warning(f"Shard {shard_id} was already committed by another worker")
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return False
+
+        return True
+
+
+def run_worker(work_dir: Path | str, process_row: RowProcessor, lease_timeout: float = 300,
+               heartbeat_interval: float = 30, poll_interval: float = 10) -> int:
+    """
+    Process shards until every shard is done. Shards leased by other workers are waited for, so crashed workers'
+    shards are taken over once their leases expire.
+
+    Args:
+        work_dir: The shared, planned work directory
+        process_row: The row processor
+        lease_timeout: Seconds without heartbeat after which a lease is expired
+        heartbeat_interval: Seconds between heartbeats, must be well below lease_timeout
+        poll_interval: Seconds to wait when every pending shard is leased by others
+
+    Returns: Number of shards committed by this worker
+
+    """
+    queue = ShardQueue(work_dir, lease_timeout, heartbeat_interval)
+    n_committed = 0
+
+    while queue.get_pending():
+        claimed = queue.claim()
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+
+        shard_id, lease = claimed
+        logger.info(f"Worker '{queue.worker_id}' processing shard {shard_id}")
+        try:
+            n_committed += queue.process_shard(shard_id, lease, process_row)
+        finally:
+            lease.release()
+
+    return n_committed
+
+
+def merge_shards(work_dir: Path | str, dst_root: Path | str) -> dict[str, int]:
+    """
+    Move the outputs of every finished shard under the destination root and combine their failure logs into
+    <work_dir>/failures.jsonl.
+
+    Args:
+        work_dir: The shared work directory
+        dst_root: The root to move the shard outputs to (e.g. summer23_chtree_root)
+
+    Returns: Dict with the number of merged and missing shards, moved files and failures
+
+    """
+    queue = ShardQueue(work_dir)
+    dst_root = Path(dst_root)
+    stats = {"merged_shards": 0, "missing_shards": len(queue.get_pending()), "files": 0, "failures": 0}
+
+    with (queue.work_dir / FAILURES_NAME).open("w") as failures_fp:
+        for shard_id in queue.shard_ids:
+            output_dir = queue.get_output_dir(shard_id)
+            if not output_dir.exists():
+                continue
+
+            for path in output_dir.rglob("*"):
+                if path.is_dir():
+                    continue
+                if path.relative_to(output_dir) == Path(FAILURES_NAME):
+                    with path.open() as fp:
+                        for failure_line in fp:
+                            failures_fp.write(failure_line)
+                            stats["failures"] += 1
+                    continue
+
+                dst_path = dst_root / path.relative_to(output_dir)
+                dst_path.parent.mkdir(exist_ok=True, parents=True)
+                shutil.move(path, dst_path)
+                stats["files"] += 1
+
+            stats["merged_shards"] += 1
+
+    return stats
+
+
+def run_local(work_dir: Path | str, process_row: RowProcessor, n_workers: int, **worker_kwargs) -> int:
+    """
+    Run several worker processes on this machine, each acting as a separate node
+
+    Returns: Total number of committed shards
+
+    """
+    with multiprocessing.Pool(n_workers) as pool:
+        results = [pool.apply_async(run_worker, (work_dir, process_row), worker_kwargs) for _ in range(n_workers)]
+        return sum(result.get() for result in results)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Sharded processing of the summer23 dataset on several nodes")
+    arg_parser.add_argument("command", choices=["plan", "worker", "local", "merge"])
+    arg_parser.add_argument("work_dir", help="Work directory on a filesystem shared by the nodes")
+    arg_parser.add_argument("--n-shards", type=int, default=256)
+    arg_parser.add_argument("--n-workers", type=int, default=os.cpu_count())
+    arg_parser.add_argument("--lease-timeout", type=float, default=300)
+    arg_parser.add_argument("--heartbeat-interval", type=float, default=30)
+    args = arg_parser.parse_args()
+
+    from common.config import CONFIG
+    from common.util.figure import get_lines_from_file
+    from datasets.commit_repr_23summer import get_shard_key, process_shard_row, setup_logging
+
+    # Several workers share the log file, so it is not rotated
+    setup_logging(rotate=False)
+
+    worker_kwargs = {"lease_timeout": args.lease_timeout, "heartbeat_interval": args.heartbeat_interval}
+
+    if args.command == "plan":
+        plan_shards(get_lines_from_file(CONFIG.summer23_dataset_path)[1:], args.work_dir, args.n_shards,
+                    get_shard_key)
+    elif args.command == "worker":
+        print(f"Committed {run_worker(args.work_dir, process_shard_row, **worker_kwargs)} shards")
+    elif args.command == "local":
+        print(f"Committed {run_local(args.work_dir, process_shard_row, args.n_workers, **worker_kwargs)} shards")
+    else:
+        print(merge_shards(args.work_dir, CONFIG.summer23_chtree_root))
+
+
+if __name__ == '__main__':
+    main()
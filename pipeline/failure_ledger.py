@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+import argparse
+import sqlite3
+import threading
+import time
+
+import requests
+
+
+class PipelineError(Exception):
+    """Base class of the failures of a pipeline stage, category is the failure ledger category."""
+    category = "other"
+
+
+class SourceNotFoundError(PipelineError):
+    category = "source_not_found"
+
+
+class ParseError(PipelineError):
+    category = "parse_error"
+
+
+class MethodNotFoundError(PipelineError):
+    category = "method_not_found"
+
+
+class DiffError(PipelineError):
+    category = "diff_error"
+
+
+class BudgetExceededError(PipelineError):
+    """Raised when a row exceeds one of its resource budgets, reason is the exceeded budget (e.g. "parse_timeout")."""
+    category = "budget_exceeded"
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(f"{reason}: {message}")
+        self.reason = reason
+
+    def __reduce__(self):
+        return type(self), (self.reason, str(self).removeprefix(f"{self.reason}: "))
+
+
+@dataclass
+class RetryPolicy:
+    """
+    When a failed key may be attempted again. After max_attempts failures the failure is permanent, before that the
+    key is retried once retry_after seconds passed since its last failure.
+
+    """
+    max_attempts: int
+    retry_after: float = 0
+
+
+RETRY_POLICIES = {
+    # 404, 410, ... will not appear on their own
+    "http_client_error": RetryPolicy(max_attempts=1),
+    # 5xx, 408 and 429 are usually temporary
+    "http_server_error": RetryPolicy(max_attempts=5, retry_after=3600),
+    "network_error": RetryPolicy(max_attempts=5, retry_after=600),
+    # Missing from the local mirror, only appears if the mirror is fetched
+    "source_not_found": RetryPolicy(max_attempts=3, retry_after=86400),
+    "parse_error": RetryPolicy(max_attempts=1),
+    "method_not_found": RetryPolicy(max_attempts=1),
+    "diff_error": RetryPolicy(max_attempts=1),
+    # Deterministic for the same budgets, clear the category after raising them
+    "budget_exceeded": RetryPolicy(max_attempts=1),
+    "other": RetryPolicy(max_attempts=3),
+}
+
+TRANSIENT_HTTP_STATUSES = (408, 429)
+
+
+@dataclass
+class FailureRecord:
+    key: str
+    category: str
+    status: int | None
+    message: str
+    first_seen: float
+    last_seen: float
+    attempts: int
+
+
+class KnownFailureError(PipelineError):
+    """Raised instead of attempting a key again whose failure is known and may not be retried yet."""
+
+    def __init__(self, record: FailureRecord):
+        super().__init__(f"Known {record.category} failure of '{record.key}' ({record.attempts} attempts): "
+                         f"{record.message}")
+        self.record = record
+        self.category = record.category
+
+
+def categorize(ex: Exception) -> tuple[str, int | None]:
+    """
+    Get the failure category and HTTP status of an exception
+
+    Args:
+        ex: The exception of the failure
+
+    Returns: Tuple of: category, HTTP status or None
+
+    """
+    if isinstance(ex, requests.exceptions.HTTPError) and ex.response is not None:
+        status = ex.response.status_code
+        if status >= 500 or status in TRANSIENT_HTTP_STATUSES:
+            return "http_server_error", status
+        return "http_client_error", status
+
+    if isinstance(ex, requests.exceptions.RequestException):
+        return "network_error", None
+
+    if isinstance(ex, KnownFailureError):
+        return ex.record.category, ex.record.status
+
+    if isinstance(ex, PipelineError):
+        return ex.category, None
+
+    return "other", None
+
+
+class FailureLedger:
+    """
+    Persistent (SQLite) record of failed keys, e.g. download URLs and csv rows, serving as a negative cache: a key whose
+    failure is permanent or too recent according to the retry policy of its category is not attempted again. The ledger
+    can be shared by the threads of a process.
+
+    """
+
+    def __init__(self, path: Path | str, policies: dict[str, RetryPolicy] | None = None):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self.policies = {**RETRY_POLICIES, **(policies or {})}
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS failures (
+                key TEXT PRIMARY KEY,
+                category TEXT NOT NULL,
+                status INTEGER,
+                message TEXT NOT NULL,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                attempts INTEGER NOT NULL
+            )
+        """)
+        self.connection.commit()
+
+    def get(self, key: str) -> FailureRecord | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT key, category, status, message, first_seen, last_seen, attempts FROM failures WHERE key = ?",
+                (key,)).fetchone()
+        return FailureRecord(*row) if row else None
+
+    def should_skip(self, key: str) -> FailureRecord | None:
+        """
+        Check the negative cache for a key
+
+        Args:
+            key: The key to check
+
+        Returns: The failure record if the key may not be attempted now, None otherwise
+
+        """
+        record = self.get(key)
+        if record is None:
+            return None
+
+        policy = self.policies.get(record.category, self.policies["other"])
+        if record.attempts >= policy.max_attempts or time.time() - record.last_seen < policy.retry_after:
+            return record
+
+        return None
+
+    def raise_if_known(self, key: str) -> None:
+        record = self.should_skip(key)
+        if record:
+            raise KnownFailureError(record)
+
+    def record(self, key: str, ex: Exception) -> FailureRecord:
+        """
+        Record a failed attempt of a key
+
+        Args:
+            key: The key that failed
+            ex: The exception of the failure
+
+        Returns: The updated failure record
+
+        """
+        category, status = categorize(ex)
+        now = time.time()
+
+        with self.lock:
+            self.connection.execute("""
+                INSERT INTO failures (key, category, status, message, first_seen, last_seen, attempts)
+                VALUES (?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT(key) DO UPDATE SET
+                    category = excluded.category, status = excluded.status, message = excluded.message,
+                    last_seen = excluded.last_seen, attempts = attempts + 1
+            """, (key, category, status, str(ex), now, now))
+            self.connection.commit()
+
+            return self.get(key)
+
+    def clear(self, key: str) -> None:
+        """Forget the failures of a key, e.g. because it succeeded."""
+        with self.lock:
+            if self.connection.execute("DELETE FROM failures WHERE key = ?", (key,)).rowcount:
+                self.connection.commit()
+
+    def clear_category(self, category: str) -> int:
+        """Forget every failure of a category so they are retried, returns the number of forgotten keys."""
+        with self.lock:
+            n_deleted = self.connection.execute("DELETE FROM failures WHERE category = ?", (category,)).rowcount
+            self.connection.commit()
+        return n_deleted
+
+    def summary(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT category, COUNT(*) FROM failures GROUP BY category ORDER BY 2 DESC"))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Inspect or reset the failure ledger")
+    arg_parser.add_argument("command", choices=["summary", "clear"])
+    arg_parser.add_argument("ledger_path")
+    arg_parser.add_argument("--category", help="The category to clear, required by clear")
+    args = arg_parser.parse_args()
+    if args.command == "clear" and args.category is None:
+        arg_parser.error("clear requires --category (see summary for the categories)")
+
+    ledger = FailureLedger(args.ledger_path)
+    if args.command == "summary":
+        for category, count in ledger.summary().items():
+            print(f"{category}: {count}")
+    else:
+        print(f"Cleared {ledger.clear_category(args.category)} failures")
+    ledger.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, ContextManager, Iterator
+import ctypes
+import functools
+import gc
+import os
+import sys
+import tracemalloc
+
+# Caches are flushed when the RSS reaches this fraction of the memory limit
+SOFT_LIMIT_FRACTION = 0.9
+
+_accountant: MemoryAccountant | None = None
+
+
+def get_rss() -> int:
+    """
+    Get the resident set size of the process in bytes: the current one on Linux, the peak one on other Unix systems and
+    0 where neither is available (Windows), so no memory limit is reached there
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError, ValueError):
+        return get_peak_rss()
+
+
+def get_peak_rss() -> int:
+    try:
+        import resource
+    except ImportError:
+        return 0
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+@dataclass
+class StageMemory:
+    """
+    Memory use of a stage: the largest Python allocation peak and RSS growth of a call, and the bytes still allocated
+    at the end of the sampled calls by allocation site ("file:line")
+    """
+    name: str
+    n_calls: int = 0
+    max_traced_peak: int = 0
+    max_rss_growth: int = 0
+    total_rss_growth: int = 0
+    n_snapshots: int = 0
+    allocation_sites: Counter = field(default_factory=Counter)
+
+
+class MemoryAccountant:
+    """
+    Accounts the memory used by the stages of the processing with tracemalloc and the RSS of the process. Every
+    snapshot_interval-th call of a stage is compared to a snapshot taken before it to find the allocation sites of the
+    memory it retains. With a memory limit, memory is freed once the RSS gets close to it (see check_limit), and the
+    processing is expected to stop if that is not enough.
+
+    """
+
+    def __init__(self, memory_limit_mb: int | None = None, trace: bool = True, snapshot_interval: int = 100,
+                 top_n: int = 10):
+        """
+        Args:
+            memory_limit_mb: The memory limit, None for no limit
+            trace: Whether to trace the Python allocations, otherwise only the RSS is accounted
+            snapshot_interval: Every how many calls of a stage its retained allocations are compared
+            top_n: The number of allocation sites and modules in the report
+        """
+        self.memory_limit = memory_limit_mb * 2 ** 20 if memory_limit_mb else None
+        self.trace = trace
+        self.snapshot_interval = snapshot_interval
+        self.top_n = top_n
+        self.stages: dict[str, StageMemory] = {}
+        self.flush_callbacks: list[Callable[[], None]] = []
+        self.n_flushes = 0
+        self.started_tracing = trace and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    def register_flush(self, callback: Callable[[], None]) -> None:
+        """Register a function freeing memory, e.g. writing buffered outputs or clearing a cache."""
+        self.flush_callbacks.append(callback)
+
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+
+    @contextmanager
+    def track(self, stage: str) -> Iterator[None]:
+        """Account the memory used in a block to a stage, blocks of stages must not be nested."""
+        stats = self.stages.setdefault(stage, StageMemory(stage))
+        before_snapshot = None
+        if self.trace:
+            if stats.n_calls % self.snapshot_interval == 0:
+                before_snapshot = self.take_snapshot()
+            tracemalloc.reset_peak()
+            start_traced = tracemalloc.get_traced_memory()[0]
+
+        start_rss = get_rss()
+        try:
+            yield
+        finally:
+            stats.n_calls += 1
+            if self.trace:
+                stats.max_traced_peak = max(stats.max_traced_peak, tracemalloc.get_traced_memory()[1] - start_traced)
+            rss_growth = max(get_rss() - start_rss, 0)
+            stats.max_rss_growth = max(stats.max_rss_growth, rss_growth)
+            stats.total_rss_growth += rss_growth
+
+            if before_snapshot is not None:
+                stats.n_snapshots += 1
+                for diff in self.take_snapshot().compare_to(before_snapshot, "lineno"):
+                    if diff.size_diff > 0:
+                        frame = diff.traceback[0]
+                        stats.allocation_sites[f"{frame.filename}:{frame.lineno}"] += diff.size_diff
+
+    def check_limit(self) -> bool:
+        """
+        Free memory when the RSS gets close to the memory limit: call the flush callbacks, collect the garbage and
+        return the freed heap memory to the OS
+
+        Returns: Whether the RSS is still above the limit after freeing, the processing should then stop before the
+            process runs out of memory
+
+        """
+        if self.memory_limit is None or get_rss() < self.memory_limit * SOFT_LIMIT_FRACTION:
+            return False
+
+        for callback in self.flush_callbacks:
+            callback()
+        gc.collect()
+        trim_heap()
+        self.n_flushes += 1
+
+        return get_rss() >= self.memory_limit
+
+    def get_report(self) -> str:
+        """Report of the memory use of the stages and the allocation sites and modules retaining the most memory."""
+        mb = lambda n_bytes: f"{n_bytes / 2 ** 20:.1f} MB"
+        kb = lambda n_bytes: f"{n_bytes / 2 ** 10:.1f} KB"
+        lines = [f"Peak RSS: {mb(get_peak_rss())}, current RSS: {mb(get_rss())}, "
+                 f"flushes at the memory limit: {self.n_flushes}"]
+
+        modules = Counter()
+        for stats in self.stages.values():
+            python_peak = f", max Python peak {mb(stats.max_traced_peak)}" if self.trace else ""
+            lines.append(f"{stats.name:>10}: {stats.n_calls} calls{python_peak}, max RSS growth "
+                         f"{mb(stats.max_rss_growth)}, total RSS growth {mb(stats.total_rss_growth)}")
+            for site, size in stats.allocation_sites.most_common(self.top_n):
+                lines.append(f"{'':>12}{kb(size / stats.n_snapshots):>10} per call retained at {site}")
+            for site, size in stats.allocation_sites.items():
+                modules[site.rsplit(":", 1)[0]] += size / stats.n_snapshots
+
+        if modules:
+            lines.append("Retained per call by module:")
+            for module, size in modules.most_common(self.top_n):
+                lines.append(f"{'':>12}{kb(size):>10} {Path(module).as_posix()}")
+
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        if self.started_tracing:
+            tracemalloc.stop()
+
+
+def trim_heap() -> None:
+    """Return the free memory of the C heap to the OS, where the C library supports it (glibc)."""
+    if not sys.platform.startswith("linux"):
+        return
+
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def stop_tracing() -> None:
+    """Process pool initializer: worker processes are not accounted, so they must not pay for tracing."""
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def set_accountant(accountant: MemoryAccountant | None) -> None:
+    global _accountant
+    _accountant = accountant
+
+
+def track_memory(stage: str) -> ContextManager[None]:
+    """Account a block to a stage if memory accounting is enabled (see set_accountant)."""
+    return _accountant.track(stage) if _accountant else nullcontext()
+
+
+def memory_tracked(stage: str) -> Callable[[Callable], Callable]:
+    """Decorator accounting the calls of a function to a stage if memory accounting is enabled."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_memory(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
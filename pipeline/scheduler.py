@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable, Iterable, Iterator
+import multiprocessing
+import queue
+import threading
+import time
+
+# Marks the end of the items of a queue
+_END = object()
+
+
+@dataclass
+class Stage:
+    """
+    A step of a StagedPipeline. I/O bound stages run func on worker threads. CPU bound stages (use_processes) run it
+    in a process pool of the same size, so func, its input and its output must be picklable. The pool processes are
+    started by a fork server (spawned where there is none, e.g. on Windows), not forked from the threads of the
+    pipeline, and run initializer when they start.
+    queue_size bounds the number of items waiting for the stage, a full queue blocks the stage before it (backpressure).
+
+    """
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    use_processes: bool = False
+    queue_size: int = 64
+    initializer: Callable[[], None] | None = None
+
+
+@dataclass
+class StageStats:
+    """
+    Time spent by the workers of a stage: busy running func, starved waiting for input, blocked waiting for room in
+    the next queue
+    """
+    name: str
+    workers: int
+    n_items: int = 0
+    n_failed: int = 0
+    busy_time: float = 0
+    starved_time: float = 0
+    blocked_time: float = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, busy_time: float, starved_time: float, blocked_time: float, failed: bool) -> None:
+        with self.lock:
+            self.n_items += 1
+            self.n_failed += failed
+            self.busy_time += busy_time
+            self.starved_time += starved_time
+            self.blocked_time += blocked_time
+
+    def get_utilization(self, wall_time: float) -> float:
+        return self.busy_time / (wall_time * self.workers) if wall_time > 0 else 0
+
+
+@dataclass
+class PipelineResult:
+    """
+    The outcome of an item: the output of the last stage, or the error and the stage it failed in. stage_times has
+    the seconds spent on the item by each stage it went through.
+    """
+    key: Hashable
+    value: Any = None
+    error: Exception | None = None
+    failed_stage: str | None = None
+    stage_times: dict[str, float] = field(default_factory=dict)
+
+
+class StagedPipeline:
+    """
+    Runs items through stages connected by bounded queues, so the stages work on different items concurrently and
+    the end-to-end throughput approaches that of the slowest stage. A failed item skips the rest of the stages.
+
+    """
+
+    def __init__(self, stages: list[Stage]):
+        self.stages = stages
+        self.stats = [StageStats(stage.name, stage.workers) for stage in stages]
+        self.wall_time = 0.0
+
+    def run_worker(self, stage_idx: int, in_queue: queue.Queue, out_queue: queue.Queue,
+                   executor: ProcessPoolExecutor | None, n_running: list[int], lock: threading.Lock) -> None:
+        stage, stats = self.stages[stage_idx], self.stats[stage_idx]
+        next_workers = self.stages[stage_idx + 1].workers if stage_idx + 1 < len(self.stages) else 1
+
+        while True:
+            wait_start = time.perf_counter()
+            item = in_queue.get()
+            starved_time = time.perf_counter() - wait_start
+            if item is _END:
+                break
+
+            result = item
+            if result.error is None:
+                busy_start = time.perf_counter()
+                try:
+                    if executor:
+                        result.value = executor.submit(stage.func, result.value).result()
+                    else:
+                        result.value = stage.func(result.value)
+                except Exception as ex:
+                    result.value, result.error, result.failed_stage = None, ex, stage.name
+                result.stage_times[stage.name] = time.perf_counter() - busy_start
+            busy_time = result.stage_times.get(stage.name, 0)
+
+            wait_start = time.perf_counter()
+            out_queue.put(result)
+            stats.add(busy_time, starved_time, time.perf_counter() - wait_start, result.failed_stage == stage.name)
+
+        # The last worker of the stage to finish ends the input of the next stage
+        with lock:
+            n_running[0] -= 1
+            if n_running[0] == 0:
+                for _ in range(next_workers):
+                    out_queue.put(_END)
+
+    def run(self, items: Iterable[tuple[Hashable, Any]]) -> Iterator[PipelineResult]:
+        """
+        Run items through the stages
+
+        Args:
+            items: (key, input of the first stage) tuples, consumed lazily as the first queue has room
+
+        Returns: Iterator of the results in completion order, an exception raised by items is raised after the results
+            of the items before it
+
+        """
+        queues = [queue.Queue(stage.queue_size) for stage in self.stages]
+        queues.append(queue.Queue(self.stages[-1].queue_size))
+        # Forking while the worker threads hold locks (logging, sqlite, git processes) could deadlock the children
+        mp_context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+        executors = [ProcessPoolExecutor(stage.workers, mp_context, stage.initializer) if stage.use_processes else None
+                     for stage in self.stages]
+
+        # An exception raised by items ends the input, it is raised once the items already fed are through
+        feed_errors = []
+
+        def feed() -> None:
+            try:
+                for key, value in items:
+                    queues[0].put(PipelineResult(key, value))
+            except Exception as ex:
+                feed_errors.append(ex)
+            finally:
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_END)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for stage_idx, stage in enumerate(self.stages):
+            n_running, lock = [stage.workers], threading.Lock()
+            threads.extend(threading.Thread(target=self.run_worker, daemon=True, args=(
+                stage_idx, queues[stage_idx], queues[stage_idx + 1], executors[stage_idx], n_running, lock))
+                           for _ in range(stage.workers))
+
+        start = time.perf_counter()
+        try:
+            for thread in threads:
+                thread.start()
+
+            while (result := queues[-1].get()) is not _END:
+                yield result
+
+            if feed_errors:
+                raise feed_errors[0]
+        finally:
+            self.wall_time = time.perf_counter() - start
+            for executor in executors:
+                if executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_report(self) -> str:
+        """Per stage utilization report of the last run, the bottleneck is the stage with the highest utilization."""
+        lines = [f"Pipeline wall time: {self.wall_time:.1f}s"]
+        for stats in self.stats:
+            lines.append(f"{stats.name:>10}: {stats.workers:3d} workers, {stats.n_items:7d} items "
+                         f"({stats.n_failed} failed), utilization {stats.get_utilization(self.wall_time):6.1%}, "
+                         f"busy {stats.busy_time:.1f}s, starved {stats.starved_time:.1f}s, "
+                         f"blocked {stats.blocked_time:.1f}s")
+
+        bottleneck = max(self.stats, key=lambda stats: stats.get_utilization(self.wall_time))
+        lines.append(f"Bottleneck: {bottleneck.name}")
+
+        return "\n".join(lines)
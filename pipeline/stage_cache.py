@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Any
+import hashlib
+import json
+import pickle
+
+
+def hash_bytes(data: bytes) -> str:
+    """
+    Get the content hash of some bytes
+
+    Args:
+        data: The bytes to hash
+
+    Returns: Hex digest of the content hash
+
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_json(obj: Any) -> str:
+    """
+    Get a content hash for a JSON serializable object, independent of dict key order
+
+    Args:
+        obj: The object to hash
+
+    Returns: Hex digest of the content hash
+
+    """
+    return hash_bytes(json.dumps(obj, sort_keys=True, default=str).encode())
+
+
+@dataclass
+class StageRecord:
+    """
+    What a single pipeline stage consumed and produced for a row.
+
+    """
+    params: dict
+    input_hash: str
+    output_hash: str
+    output_file: str | None = None
+    value: Any = None
+
+
+class StageCache:
+    """
+    Per-row pipeline manifest. For every stage the parameters, the hash of its inputs (the parameters together with the
+    output hashes of the upstream stages) and the hash of its output are recorded. A stage has to be recomputed only
+    when its input hash differs from the recorded one, so changing a parameter only invalidates the stages that depend
+    on it. Outputs worth keeping are pickled next to the manifest.
+
+    """
+
+    MANIFEST_NAME = "manifest.json"
+
+    def __init__(self, cache_root: Path | str, row_key: str):
+        self.row_dir = Path(cache_root) / row_key[:2] / row_key
+        self.manifest_path = self.row_dir / self.MANIFEST_NAME
+        self.records: dict[str, StageRecord] = {}
+        self.dirty = False
+
+        if self.manifest_path.exists():
+            with self.manifest_path.open() as fp:
+                content = json.load(fp)
+            self.records = {stage: StageRecord(**record) for stage, record in content.items()}
+
+    @staticmethod
+    def get_input_hash(stage: str, params: dict, upstream: list[str]) -> str:
+        return hash_json({"stage": stage, "params": params, "upstream": upstream})
+
+    def lookup(self, stage: str, params: dict, upstream: list[str]) -> StageRecord | None:
+        """
+        Get the record of a stage if it is still valid for the given inputs
+
+        Args:
+            stage: Name of the stage
+            params: Parameters of the stage
+            upstream: Output hashes of the stages this one depends on
+
+        Returns: The StageRecord if the stage does not have to be recomputed, None otherwise
+
+        """
+        record = self.records.get(stage)
+        if record is None or record.input_hash != self.get_input_hash(stage, params, upstream):
+            return None
+
+        if record.output_file and not (self.row_dir / record.output_file).exists():
+            return None
+
+        return record
+
+    def store(self, stage: str, params: dict, upstream: list[str], output_hash: str | None = None,
+              output: Any = None, value: Any = None) -> StageRecord:
+        """
+        Record the result of a (re)computed stage
+
+        Args:
+            stage: Name of the stage
+            params: Parameters of the stage
+            upstream: Output hashes of the stages this one depends on
+            output_hash: Hash of the stage output. If None, the stage is treated as deterministic and the output hash
+                is derived from the input hash
+            output: If given, it is pickled and persisted so later runs can reload it instead of recomputing it
+            value: Small, JSON serializable output that is kept inline in the manifest
+
+        Returns: The new StageRecord
+
+        """
+        input_hash = self.get_input_hash(stage, params, upstream)
+        output_file = None
+
+        if output is not None:
+            content = pickle.dumps(output)
+            output_file = f"{stage}.pkl"
+            if output_hash is None:
+                output_hash = hash_bytes(content)
+
+            self.row_dir.mkdir(exist_ok=True, parents=True)
+            with (self.row_dir / output_file).open("wb") as fp:
+                fp.write(content)
+
+        if output_hash is None:
+            output_hash = hash_json(value) if value is not None else input_hash
+
+        record = StageRecord(params=params, input_hash=input_hash, output_hash=output_hash, output_file=output_file,
+                             value=value)
+        self.records[stage] = record
+        self.dirty = True
+
+        return record
+
+    def load_output(self, record: StageRecord) -> Any:
+        """
+        Load the persisted output of a stage
+
+        Args:
+            record: The record of the stage, whose output_file must be set
+
+        Returns: The unpickled output
+
+        """
+        with (self.row_dir / record.output_file).open("rb") as fp:
+            return pickle.load(fp)
+
+    def save(self) -> None:
+        """
+        Write the manifest to disk if anything changed
+        """
+        if not self.dirty:
+            return
+
+        self.row_dir.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with tmp_path.open("w") as fp:
+            json.dump({stage: asdict(record) for stage, record in self.records.items()}, fp, indent=1)
+        tmp_path.replace(self.manifest_path)
+        self.dirty = False
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from pathlib import Path
+import argparse
+import json
+import pickle
+import socket
+
+from service.protocol import DEFAULT_SOCKET_PATH, send_message, receive_message
+
+
+class ServiceError(Exception):
+    """A request failed on the server, category is the failure ledger category of the failure."""
+
+    def __init__(self, message: str, category: str):
+        super().__init__(message)
+        self.category = category
+
+
+class ChangeTreeClient:
+    """
+    Connection to the change tree service (service.server), requests are sent one at a time. Only the standard library
+    is imported, the grammars and the config are loaded by the running service.
+
+    """
+
+    def __init__(self, socket_path: Path | str = DEFAULT_SOCKET_PATH):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(str(socket_path))
+        self.fp = self.socket.makefile("rwb")
+
+    def request(self, header: dict, payloads: list[bytes] | None = None) -> tuple[dict, list[bytes]]:
+        send_message(self.fp, header, payloads)
+        response = receive_message(self.fp)
+        if response is None:
+            raise ConnectionError("The service closed the connection")
+
+        response_header, response_payloads = response
+        if not response_header["ok"]:
+            raise ServiceError(response_header["error"], response_header["category"])
+
+        return response_header, response_payloads
+
+    def get_chtree_bytes(self, pre_content: bytes, post_content: bytes, pre_pos: tuple[int, int],
+                         post_pos: tuple[int, int]) -> bytes:
+        """
+        Get the pickled change tree of a method
+
+        Args:
+            pre_content: The file content of the pre commit state
+            post_content: The file content of the post commit state
+            pre_pos: (line, col) of the method in the pre commit state
+            post_pos: (line, col) of the method in the post commit state
+
+        Returns: The pickled ChangeTree, as saved by the dataset processing
+
+        """
+        _, payloads = self.request({"op": "chtree", "pre_pos": list(pre_pos), "post_pos": list(post_pos)},
+                                   [pre_content, post_content])
+        return payloads[0]
+
+    def get_chtree(self, pre_content: bytes, post_content: bytes, pre_pos: tuple[int, int],
+                   post_pos: tuple[int, int]):
+        """Get the change tree of a method, unpickling it imports the change tree modules (and the grammar)."""
+        return pickle.loads(self.get_chtree_bytes(pre_content, post_content, pre_pos, post_pos))
+
+    def get_stats(self) -> dict:
+        return self.request({"op": "stats"})[0]["stats"]
+
+    def shutdown(self) -> None:
+        self.request({"op": "shutdown"})
+
+    def close(self) -> None:
+        self.fp.close()
+        self.socket.close()
+
+    def __enter__(self) -> ChangeTreeClient:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def parse_pos(pos: str) -> tuple[int, int]:
+    line, col = pos.split(":")
+    return int(line), int(col)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Client of the change tree service")
+    arg_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    chtree_parser = subparsers.add_parser("chtree", help="Get the change tree of a method")
+    chtree_parser.add_argument("pre_file")
+    chtree_parser.add_argument("post_file")
+    chtree_parser.add_argument("--pre-pos", type=parse_pos, required=True, help="line:col of the method in the pre file")
+    chtree_parser.add_argument("--post-pos", type=parse_pos, required=True,
+                               help="line:col of the method in the post file")
+    chtree_parser.add_argument("--output", "-o", required=True, help="Where to save the pickled change tree")
+    subparsers.add_parser("stats", help="Print the request latency percentiles and cache statistics")
+    subparsers.add_parser("shutdown", help="Stop the service")
+    args = arg_parser.parse_args()
+
+    with ChangeTreeClient(args.socket) as client:
+        if args.command == "stats":
+            print(json.dumps(client.get_stats(), indent=2))
+        elif args.command == "shutdown":
+            client.shutdown()
+        else:
+            chtree_bytes = client.get_chtree_bytes(Path(args.pre_file).read_bytes(), Path(args.post_file).read_bytes(),
+                                                   args.pre_pos, args.post_pos)
+            Path(args.output).write_bytes(chtree_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from typing import BinaryIO
+import json
+import os
+import struct
+
+DEFAULT_SOCKET_PATH = os.environ.get("CHTREE_SOCKET", "/tmp/chtree_service.sock")
+
+# A message is the header length, a JSON header and the binary payloads whose sizes are listed in the header. This
+# module must not import the project, so clients start without loading the grammars and the config
+HEADER_SIZE = struct.Struct(">I")
+
+
+def send_message(fp: BinaryIO, header: dict, payloads: list[bytes] | None = None) -> None:
+    payloads = payloads or []
+    header_bytes = json.dumps({**header, "payload_sizes": [len(payload) for payload in payloads]}).encode()
+
+    fp.write(HEADER_SIZE.pack(len(header_bytes)))
+    fp.write(header_bytes)
+    for payload in payloads:
+        fp.write(payload)
+    fp.flush()
+
+
+def read_exactly(fp: BinaryIO, size: int) -> bytes:
+    data = fp.read(size)
+    if len(data) != size:
+        raise EOFError("Connection closed in the middle of a message")
+    return data
+
+
+def receive_message(fp: BinaryIO) -> tuple[dict, list[bytes]] | None:
+    """
+    Read a message
+
+    Args:
+        fp: The reading file of the socket
+
+    Returns: Tuple of: header, payloads; or None if the connection was closed between messages
+
+    """
+    size_bytes = fp.read(HEADER_SIZE.size)
+    if not size_bytes:
+        return None
+    if len(size_bytes) != HEADER_SIZE.size:
+        raise EOFError("Connection closed in the middle of a message")
+
+    header = json.loads(read_exactly(fp, HEADER_SIZE.unpack(size_bytes)[0]))
+    payloads = [read_exactly(fp, size) for size in header.pop("payload_sizes")]
+
+    return header, payloads
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from pathlib import Path
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import socketserver
+import stat
+import threading
+import time
+
+from tree_sitter import Node as RawNode
+
+from datasets.commit_repr_23summer import parse_commit_files, build_chtree
+from pipeline.failure_ledger import MethodNotFoundError, categorize
+from service.protocol import DEFAULT_SOCKET_PATH, send_message, receive_message
+from tree_sitter_wrapper.tree import TreeSitterTree, get_method_from_index
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ParsedFilePair:
+    pre_tree: TreeSitterTree
+    post_tree: TreeSitterTree
+    changed_ranges: tuple[list, list] | None
+    pre_method_index: list[RawNode] | None = None
+    post_method_index: list[RawNode] | None = None
+
+
+class LatencyRecorder:
+    """Latencies of the last max_samples requests of every operation."""
+
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self.latencies: dict[str, deque[float]] = {}
+        self.counts: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, op: str, latency: float) -> None:
+        with self.lock:
+            self.latencies.setdefault(op, deque(maxlen=self.max_samples)).append(latency)
+            self.counts[op] = self.counts.get(op, 0) + 1
+
+    def get_percentiles(self) -> dict[str, dict[str, float]]:
+        """Get the count and the p50, p90, p99 and max latency in milliseconds of every operation."""
+        with self.lock:
+            samples = {op: sorted(latencies) for op, latencies in self.latencies.items()}
+
+        return {op: {"count": self.counts[op],
+                     **{f"p{q}": latencies[min(len(latencies) - 1, len(latencies) * q // 100)] * 1000
+                        for q in (50, 90, 99)},
+                     "max": latencies[-1] * 1000}
+                for op, latencies in samples.items()}
+
+
+class ChangeTreeService:
+    """
+    Builds change trees like the dataset processing, with the grammar loaded once and the parsed file pairs and their
+    method indexes kept in an LRU cache, so repeated requests for the methods of a file pair skip parsing and locating.
+
+    """
+
+    def __init__(self, parse_cache_size: int = 64):
+        self.parse_cache_size = parse_cache_size
+        self.parse_cache: OrderedDict[tuple[str, str], ParsedFilePair] = OrderedDict()
+        # The tree-sitter parser is shared
+        self.parse_lock = threading.Lock()
+        self.latencies = LatencyRecorder()
+        self.started = time.time()
+        self.n_cache_hits = 0
+        self.n_cache_misses = 0
+
+    def get_parsed(self, pre_content: bytes, post_content: bytes) -> ParsedFilePair:
+        key = (hashlib.sha1(pre_content).hexdigest(), hashlib.sha1(post_content).hexdigest())
+
+        with self.parse_lock:
+            if key in self.parse_cache:
+                self.parse_cache.move_to_end(key)
+                self.n_cache_hits += 1
+                return self.parse_cache[key]
+
+            self.n_cache_misses += 1
+            parsed = ParsedFilePair(*parse_commit_files(pre_content, post_content))
+            self.parse_cache[key] = parsed
+            if len(self.parse_cache) > self.parse_cache_size:
+                self.parse_cache.popitem(last=False)
+
+        return parsed
+
+    def get_chtree_bytes(self, pre_content: bytes, post_content: bytes, pre_pos: list[int],
+                         post_pos: list[int]) -> bytes:
+        parsed = self.get_parsed(pre_content, post_content)
+        if parsed.pre_method_index is None:
+            parsed.pre_method_index = parsed.pre_tree.get_method_index()
+            parsed.post_method_index = parsed.post_tree.get_method_index()
+
+        pre_tree = get_method_from_index(parsed.pre_method_index, pre_pos[0])
+        post_tree = get_method_from_index(parsed.post_method_index, post_pos[0])
+        if pre_tree is None or post_tree is None:
+            raise MethodNotFoundError(f"No method at line {pre_pos[0] if pre_tree is None else post_pos[0]} of the "
+                                      f"{'pre' if pre_tree is None else 'post'} file")
+
+        return pickle.dumps(build_chtree(pre_tree, post_tree, parsed.changed_ranges))
+
+    def get_stats(self) -> dict:
+        return {"uptime": time.time() - self.started, "parse_cache_size": len(self.parse_cache),
+                "parse_cache_hits": self.n_cache_hits, "parse_cache_misses": self.n_cache_misses,
+                "latency_ms": self.latencies.get_percentiles()}
+
+    def handle(self, header: dict, payloads: list[bytes]) -> tuple[dict, list[bytes]]:
+        """
+        Handle a request
+
+        Args:
+            header: The request header, "op" is the operation
+            payloads: The binary payloads of the request
+
+        Returns: Tuple of: response header, response payloads
+
+        """
+        if header["op"] == "chtree":
+            return {"ok": True}, [self.get_chtree_bytes(*payloads, header["pre_pos"], header["post_pos"])]
+        if header["op"] == "stats":
+            return {"ok": True, "stats": self.get_stats()}, []
+
+        raise ValueError(f"Unknown operation '{header['op']}'")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    server: ChangeTreeServer
+
+    def handle(self) -> None:
+        while (request := receive_message(self.rfile)) is not None:
+            header, payloads = request
+            start = time.perf_counter()
+
+            if header["op"] == "shutdown":
+                send_message(self.wfile, {"ok": True})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+            try:
+                response_header, response_payloads = self.server.service.handle(header, payloads)
+            except Exception as ex:
+                response_header, response_payloads = {"ok": False, "error": str(ex), "category": categorize(ex)[0]}, []
+
+            self.server.service.latencies.add(header["op"], time.perf_counter() - start)
+            send_message(self.wfile, response_header, response_payloads)
+
+
+class ChangeTreeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path | str, service: ChangeTreeService):
+        self.service = service
+        super().__init__(str(socket_path), RequestHandler)
+
+
+def serve(socket_path: Path | str = DEFAULT_SOCKET_PATH, parse_cache_size: int = 64) -> None:
+    """
+    Serve change tree requests on a Unix socket until a shutdown request
+
+    Args:
+        socket_path: The socket path, an existing socket file is replaced
+        parse_cache_size: Number of parsed file pairs to keep
+    """
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise FileExistsError(f"'{socket_path}' exists and is not a socket")
+        os.unlink(socket_path)
+
+    with ChangeTreeServer(socket_path, ChangeTreeService(parse_cache_size)) as server:
+        logger.info(f"Serving change trees on '{socket_path}'")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Serve change tree requests with warm parsers and caches")
+    arg_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    arg_parser.add_argument("--parse-cache-size", type=int, default=64)
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(args.socket, args.parse_cache_size)
+
+
+if __name__ == '__main__':
+    main()
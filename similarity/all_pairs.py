@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from similarity.fingerprint import get_chtree_fingerprints, iter_saved_chtrees
+
+METRICS = ("jaccard", "cosine")
+
+# Bytes needed per pair of a block: intersection counts, pair keys of the matches and the similarities
+BYTES_PER_BLOCK_PAIR = 32
+
+# Shared by the worker processes, set by init_worker
+_offsets: np.ndarray | None = None
+_values: np.ndarray | None = None
+
+
+class FingerprintMatrix:
+    """
+    Sparse binary matrix of fingerprint sets in CSR-like layout: the sorted fingerprints of every set are concatenated
+    in values and the fingerprints of set i are values[offsets[i]:offsets[i + 1]].
+
+    """
+
+    def __init__(self, keys: list[str], fingerprint_sets: list[set[int]]):
+        self.keys = keys
+
+        sizes = np.fromiter((len(fingerprints) for fingerprints in fingerprint_sets), dtype=np.int64,
+                            count=len(fingerprint_sets))
+        self.offsets = np.zeros(len(fingerprint_sets) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.offsets[1:])
+
+        self.values = np.empty(self.offsets[-1], dtype=np.uint64)
+        for idx, fingerprints in enumerate(fingerprint_sets):
+            self.values[self.offsets[idx]:self.offsets[idx + 1]] = sorted(fingerprints)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
+def get_block_intersections(offsets: np.ndarray, values: np.ndarray, rows_i: range, rows_j: range,
+                            max_matches: int = 1 << 24) -> np.ndarray:
+    """
+    Count the common fingerprints for every pair of sets of two row blocks. The fingerprints of block j are sorted
+    once and the fingerprints of block i are looked up in them with binary search, matches are counted per pair.
+
+    Args:
+        offsets: Row offsets of the fingerprint matrix
+        values: Fingerprint values of the fingerprint matrix
+        rows_i: Rows of the first block
+        rows_j: Rows of the second block
+        max_matches: Maximum number of matches handled at once, bounds the temporary memory
+
+    Returns: Array of intersection sizes with shape (len(rows_i), len(rows_j))
+
+    """
+    n_i, n_j = len(rows_i), len(rows_j)
+
+    j_values = values[offsets[rows_j.start]:offsets[rows_j.stop]]
+    j_rows = np.repeat(np.arange(n_j), np.diff(offsets[rows_j.start:rows_j.stop + 1]))
+    order = np.argsort(j_values, kind="stable")
+    j_values, j_rows = j_values[order], j_rows[order]
+
+    i_values = values[offsets[rows_i.start]:offsets[rows_i.stop]]
+    i_rows = np.repeat(np.arange(n_i), np.diff(offsets[rows_i.start:rows_i.stop + 1]))
+
+    lo = np.searchsorted(j_values, i_values, side="left")
+    n_matches = np.searchsorted(j_values, i_values, side="right") - lo
+    has_match = n_matches > 0
+    lo, n_matches, i_rows = lo[has_match], n_matches[has_match], i_rows[has_match]
+
+    counts = np.zeros(n_i * n_j, dtype=np.int64)
+    cumulative = np.cumsum(n_matches)
+    chunk_start = 0
+    while chunk_start < len(n_matches):
+        matches_before = cumulative[chunk_start - 1] if chunk_start else 0
+        chunk_end = max(int(np.searchsorted(cumulative, matches_before + max_matches, side="right")), chunk_start + 1)
+
+        chunk_lo, chunk_n = lo[chunk_start:chunk_end], n_matches[chunk_start:chunk_end]
+        match_starts = np.cumsum(chunk_n) - chunk_n
+        positions = np.arange(chunk_n.sum()) - np.repeat(match_starts - chunk_lo, chunk_n)
+        pairs = np.repeat(i_rows[chunk_start:chunk_end] * n_j, chunk_n) + j_rows[positions]
+        counts += np.bincount(pairs, minlength=n_i * n_j)
+
+        chunk_start = chunk_end
+
+    return counts.reshape(n_i, n_j)
+
+
+def get_similarities(intersections: np.ndarray, sizes_i: np.ndarray, sizes_j: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Get the set similarities from the intersection sizes
+
+    Args:
+        intersections: Intersection sizes of the block
+        sizes_i: Set sizes of the block rows
+        sizes_j: Set sizes of the block columns
+        metric: Either "jaccard" or "cosine"
+
+    Returns: Array of similarities with the shape of intersections
+
+    """
+    intersections = intersections.astype(np.float32)
+    if metric == "jaccard":
+        return intersections / (sizes_i[:, np.newaxis] + sizes_j[np.newaxis, :] - intersections)
+    if metric == "cosine":
+        return intersections / np.sqrt(np.outer(sizes_i, sizes_j).astype(np.float32))
+
+    raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}")
+
+
+def get_top_k(similarities: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the k largest similarities per row
+
+    Args:
+        similarities: 2D array of similarities
+        k: Number of neighbours to keep
+
+    Returns: Tuple of: column indices, similarities; both with shape (n_rows, min(k, n_columns))
+
+    """
+    k = min(k, similarities.shape[1])
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    return top, np.take_along_axis(similarities, top, axis=1)
+
+
+def init_worker(offsets: np.ndarray, values: np.ndarray) -> None:
+    global _offsets, _values
+    _offsets, _values = offsets, values
+
+
+def compute_block(rows_i: range, rows_j: range, metric: str, k: int) -> tuple:
+    """
+    Compute the similarities of a block pair in a worker process and keep only the top-k neighbours of both sides.
+
+    Returns: Tuple of: rows_i, rows_j, (indices, similarities) for rows_i, (indices, similarities) for rows_j
+
+    """
+    sizes = np.diff(_offsets)
+    similarities = get_similarities(get_block_intersections(_offsets, _values, rows_i, rows_j),
+                                    sizes[rows_i.start:rows_i.stop], sizes[rows_j.start:rows_j.stop], metric)
+
+    if rows_i == rows_j:
+        np.fill_diagonal(similarities, -1)
+        top_i = get_top_k(similarities, k)
+        return rows_i, rows_j, (top_i[0] + rows_j.start, top_i[1]), None
+
+    top_i = get_top_k(similarities, k)
+    top_j = get_top_k(similarities.T, k)
+    return rows_i, rows_j, (top_i[0] + rows_j.start, top_i[1]), (top_j[0] + rows_i.start, top_j[1])
+
+
+class TopKNeighbours:
+    """
+    Keeps the best k neighbours of every row while block results are merged in.
+
+    """
+
+    def __init__(self, n_rows: int, k: int):
+        self.k = k
+        self.indices = np.full((n_rows, k), -1, dtype=np.int64)
+        self.similarities = np.zeros((n_rows, k), dtype=np.float32)
+
+    def merge(self, rows: range, indices: np.ndarray, similarities: np.ndarray) -> None:
+        all_indices = np.concatenate([self.indices[rows.start:rows.stop], indices], axis=1)
+        all_similarities = np.concatenate([self.similarities[rows.start:rows.stop], similarities], axis=1)
+
+        # Pairs without common fingerprints are not neighbours
+        all_indices[all_similarities <= 0] = -1
+        all_similarities[all_similarities <= 0] = 0
+
+        top, top_similarities = get_top_k(all_similarities, self.k)
+        self.indices[rows.start:rows.stop] = np.take_along_axis(all_indices, top, axis=1)
+        self.similarities[rows.start:rows.stop] = top_similarities
+
+    def sort(self) -> None:
+        order = np.argsort(-self.similarities, axis=1, kind="stable")
+        self.indices = np.take_along_axis(self.indices, order, axis=1)
+        self.similarities = np.take_along_axis(self.similarities, order, axis=1)
+
+
+def get_block_size(n_rows: int, n_workers: int, memory_limit_mb: int) -> int:
+    """
+    Get the largest block size whose temporary arrays fit into the memory limit when every worker is busy
+
+    Args:
+        n_rows: Number of sets
+        n_workers: Number of worker processes
+        memory_limit_mb: Memory ceiling for the block computations
+
+    Returns: The number of rows per block
+
+    """
+    block_size = int(math.sqrt(memory_limit_mb * 2 ** 20 / (n_workers * BYTES_PER_BLOCK_PAIR)))
+    return max(1, min(block_size, n_rows))
+
+
+def compute_all_pairs(matrix: FingerprintMatrix, k: int = 10, metric: str = "jaccard", n_workers: int | None = None,
+                      memory_limit_mb: int = 2048) -> TopKNeighbours:
+    """
+    Compute the top-k most similar sets for every set of a fingerprint matrix. The matrix is split into row blocks and
+    the block pairs (upper triangle only, the similarities are symmetric) are computed in a process pool.
+
+    Args:
+        matrix: The fingerprint sets
+        k: Number of neighbours to keep per set
+        metric: Either "jaccard" or "cosine"
+        n_workers: Number of worker processes, defaults to the number of CPUs
+        memory_limit_mb: Memory ceiling for the block computations of all workers together
+
+    Returns: TopKNeighbours object with the neighbours sorted by decreasing similarity
+
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}")
+
+    n_workers = n_workers or os.cpu_count() or 1
+    neighbours = TopKNeighbours(len(matrix), k)
+    if len(matrix) == 0:
+        return neighbours
+
+    block_size = get_block_size(len(matrix), n_workers, memory_limit_mb)
+    blocks = [range(start, min(start + block_size, len(matrix))) for start in range(0, len(matrix), block_size)]
+    block_pairs = [(rows_i, rows_j) for i, rows_i in enumerate(blocks) for rows_j in blocks[i:]]
+
+    with ProcessPoolExecutor(n_workers, initializer=init_worker, initargs=(matrix.offsets, matrix.values)) as executor:
+        futures = [executor.submit(compute_block, rows_i, rows_j, metric, k) for rows_i, rows_j in block_pairs]
+
+        for future in tqdm(futures, desc=f"Computing {len(block_pairs)} blocks of {block_size} rows"):
+            rows_i, rows_j, top_i, top_j = future.result()
+            neighbours.merge(rows_i, *top_i)
+            if top_j is not None:
+                neighbours.merge(rows_j, *top_j)
+
+    neighbours.sort()
+    return neighbours
+
+
+def save_neighbours(neighbours: TopKNeighbours, keys: list[str], path: Path | str) -> None:
+    """
+    Save the top-k neighbours. Row i of "indices" and "similarities" belongs to keys[i], missing neighbours are -1.
+
+    Args:
+        neighbours: The computed neighbours
+        keys: The keys of the sets
+        path: The file to save to (npz)
+    """
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+
+    with path.open("wb") as fp:
+        np.savez(fp, indices=neighbours.indices, similarities=neighbours.similarities, keys=np.array(json.dumps(keys)))
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="All-pairs top-k similarity of saved change trees")
+    arg_parser.add_argument("output_path", help="Path to the neighbours file (npz)")
+    arg_parser.add_argument("--chtree-root", help="Change tree save root, defaults to summer23_chtree_root")
+    arg_parser.add_argument("--prefix", default="", help="Only use change trees whose relative path starts with this")
+    arg_parser.add_argument("-k", type=int, default=10)
+    arg_parser.add_argument("--metric", choices=METRICS, default="jaccard")
+    arg_parser.add_argument("--workers", type=int)
+    arg_parser.add_argument("--memory-limit-mb", type=int, default=2048)
+    args = arg_parser.parse_args()
+
+    chtree_root = args.chtree_root
+    if chtree_root is None:
+        from common.config import CONFIG
+        chtree_root = CONFIG.summer23_chtree_root
+
+    keys, fingerprint_sets = [], []
+    for key, ch_tree in tqdm(iter_saved_chtrees(chtree_root), desc="Loading change trees"):
+        if not key.startswith(args.prefix):
+            continue
+
+        fingerprints = get_chtree_fingerprints(ch_tree)
+        if fingerprints:
+            keys.append(key)
+            fingerprint_sets.append(fingerprints)
+
+    neighbours = compute_all_pairs(FingerprintMatrix(keys, fingerprint_sets), args.k, args.metric, args.workers,
+                                   args.memory_limit_mb)
+    save_neighbours(neighbours, keys, args.output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable, Iterator
+import hashlib
+import pickle
+
+from change_tree.tree import ChangeTree
+from common.root_path import RootPath
+
+
+def get_path_fingerprint(root_path: RootPath, side: str = "") -> int:
+    """
+    Get a 64 bit fingerprint of a root path that only depends on the node types, values and positions along the path,
+    so equal paths of different files or commits get the same fingerprint.
+
+    Args:
+        root_path: The root path to fingerprint
+        side: Prefix to tell apart paths of the before ("-") and after ("+") states
+
+    Returns: The fingerprint as an unsigned integer
+
+    """
+    digest = hashlib.blake2b(f"{side}{root_path!r}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def get_chtree_fingerprints(ch_tree: ChangeTree) -> set[int]:
+    """
+    Get the fingerprint set of a change tree: the fingerprints of the root paths that are present only in the before or
+    only in the after state of the code change.
+
+    Args:
+        ch_tree: The change tree to fingerprint
+
+    Returns: Set of root path fingerprints
+
+    """
+    before_paths = set(ch_tree.before_paths)
+    after_paths = set(ch_tree.after_paths)
+
+    fingerprints = {get_path_fingerprint(path, "-") for path in before_paths - after_paths}
+    fingerprints.update(get_path_fingerprint(path, "+") for path in after_paths - before_paths)
+
+    return fingerprints
+
+
+def iter_saved_chtrees(chtree_root: Path | str, skip: Callable[[str], bool] | None = None) \
+        -> Iterator[tuple[str, ChangeTree]]:
+    """
+    Iterate over the pickled change trees saved by a dataset script (e.g. datasets.commit_repr_23summer)
+
+    Args:
+        chtree_root: The change tree save root
+        skip: Predicate on the relative paths of the change trees not to load
+
+    Returns: Iterator of (path relative to the root, change tree) tuples
+
+    """
+    chtree_root = Path(chtree_root)
+
+    for chtree_path in sorted(chtree_root.rglob("*.pkl")):
+        key = chtree_path.relative_to(chtree_root).as_posix()
+        if skip and skip(key):
+            continue
+
+        with chtree_path.open("rb") as fp:
+            ch_tree = pickle.load(fp)
+        yield key, ch_tree
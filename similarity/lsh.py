@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Iterable
+import argparse
+import json
+import pickle
+import random
+import time
+
+import numpy as np
+
+from similarity.fingerprint import get_chtree_fingerprints, iter_saved_chtrees
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+class MinHasher:
+    """
+    Computes MinHash signatures of fingerprint sets with universal hash functions h(x) = (a * x + b) mod p.
+    Fingerprints and coefficients are kept below 2^32, so the products fit into uint64 without overflow.
+
+    """
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        generator = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = generator.integers(1, MAX_HASH, num_perm, dtype=np.uint64)
+        self.b = generator.integers(0, MAX_HASH, num_perm, dtype=np.uint64)
+
+    def signature(self, fingerprints: Iterable[int]) -> np.ndarray:
+        """
+        Get the MinHash signature of a fingerprint set
+
+        Args:
+            fingerprints: The (64 bit) fingerprints of the set
+
+        Returns: Array of num_perm uint32 minimum hash values
+
+        """
+        values = np.fromiter(fingerprints, dtype=np.uint64) & np.uint64(MAX_HASH)
+        if values.size == 0:
+            return np.full(self.num_perm, MAX_HASH, dtype=np.uint32)
+
+        hashes = (np.outer(values, self.a) + self.b) % np.uint64(MERSENNE_PRIME)
+        return (hashes & np.uint64(MAX_HASH)).min(axis=0).astype(np.uint32)
+
+
+class LSHIndex:
+    """
+    Similarity index over fingerprint sets (e.g. change trees, see similarity.fingerprint). The MinHash signatures are
+    split into bands and every band is hashed into its own bucket table, so the candidates of a query are the sets
+    sharing at least one band with it. Candidates are ranked by their estimated Jaccard similarity.
+
+    """
+
+    def __init__(self, num_perm: int = 128, n_bands: int = 32, seed: int = 1):
+        if num_perm % n_bands != 0:
+            raise ValueError(f"Number of permutations ({num_perm}) must be divisible by number of bands ({n_bands})")
+
+        self.hasher = MinHasher(num_perm, seed)
+        self.seed = seed
+        self.n_bands = n_bands
+        self.rows_per_band = num_perm // n_bands
+
+        self.keys: list[str] = []
+        self.key_to_idx: dict[str, int] = {}
+        self.buckets: list[dict[int, list[int]]] = [{} for _ in range(n_bands)]
+        self.band_multipliers = np.random.default_rng(seed).integers(1, 1 << 63, self.rows_per_band, dtype=np.uint64) | 1
+        self._signatures = np.empty((1024, num_perm), dtype=np.uint32)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.key_to_idx
+
+    @property
+    def signatures(self) -> np.ndarray:
+        return self._signatures[:len(self.keys)]
+
+    def get_band_hashes(self, signatures: np.ndarray) -> np.ndarray:
+        """
+        Hash every band of signatures into a single integer (the bucket key of the band)
+
+        Args:
+            signatures: A single signature or a 2D array with one signature per row
+
+        Returns: Array of uint64 band hashes with the shape (n_signatures, n_bands)
+
+        """
+        bands = np.atleast_2d(signatures).reshape(-1, self.n_bands, self.rows_per_band).astype(np.uint64)
+        return (bands * self.band_multipliers).sum(axis=2, dtype=np.uint64)
+
+    def add_signatures(self, keys: list[str], signatures: np.ndarray) -> None:
+        """
+        Add already computed signatures to the index
+
+        Args:
+            keys: Unique keys of the indexed items
+            signatures: Their MinHash signatures, one per row
+        """
+        for key in keys:
+            if key in self.key_to_idx:
+                raise ValueError(f"Key '{key}' is already in the index")
+
+        start = len(self.keys)
+        end = start + len(keys)
+        if end > len(self._signatures):
+            grown = np.empty((max(end, 2 * len(self._signatures)), self.hasher.num_perm), dtype=np.uint32)
+            grown[:start] = self.signatures
+            self._signatures = grown
+
+        self._signatures[start:end] = signatures
+        self.keys.extend(keys)
+        self.key_to_idx.update((key, idx) for idx, key in enumerate(keys, start))
+
+        band_hashes = self.get_band_hashes(signatures)
+        for bucket, band_column in zip(self.buckets, band_hashes.T.tolist()):
+            for idx, band_hash in enumerate(band_column, start):
+                bucket.setdefault(band_hash, []).append(idx)
+
+    def add(self, key: str, fingerprints: set[int]) -> None:
+        """
+        Add a fingerprint set to the index
+
+        Args:
+            key: Unique key of the indexed item
+            fingerprints: Its fingerprint set, must not be empty
+        """
+        if not fingerprints:
+            raise ValueError(f"Can not index empty fingerprint set for key '{key}'")
+
+        self.add_signatures([key], self.hasher.signature(fingerprints)[np.newaxis])
+
+    def query(self, fingerprints: set[int], k: int = 10) -> list[tuple[str, float]]:
+        """
+        Get the most similar indexed items to a fingerprint set
+
+        Args:
+            fingerprints: The fingerprint set to search for
+            k: Maximum number of results
+
+        Returns: List of (key, estimated Jaccard similarity) tuples, most similar first
+
+        """
+        signature = self.hasher.signature(fingerprints)
+
+        candidates = set()
+        for bucket, band_hash in zip(self.buckets, self.get_band_hashes(signature)[0].tolist()):
+            candidates.update(bucket.get(band_hash, ()))
+
+        if not candidates:
+            return []
+
+        candidate_idxs = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarities = (self._signatures[candidate_idxs] == signature).mean(axis=1)
+
+        if len(candidate_idxs) > k:
+            top = np.argpartition(-similarities, k)[:k]
+            candidate_idxs, similarities = candidate_idxs[top], similarities[top]
+
+        order = np.argsort(-similarities, kind="stable")
+        return [(self.keys[candidate_idxs[i]], float(similarities[i])) for i in order]
+
+    def save(self, path: Path | str) -> None:
+        """
+        Persist the index. Only the signatures and keys are stored, the buckets are rebuilt on load.
+
+        Args:
+            path: The file to save the index to (npz)
+        """
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+
+        meta = {"num_perm": self.hasher.num_perm, "n_bands": self.n_bands, "seed": self.seed, "keys": self.keys}
+        with path.open("wb") as fp:
+            np.savez(fp, signatures=self.signatures, meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path: Path | str) -> LSHIndex:
+        """
+        Load an index saved by LSHIndex.save
+
+        Args:
+            path: The saved index file
+
+        Returns: The loaded LSHIndex object
+
+        """
+        with np.load(path) as content:
+            meta = json.loads(str(content["meta"]))
+            signatures = content["signatures"]
+
+        index = cls(meta["num_perm"], meta["n_bands"], meta["seed"])
+        index.add_signatures(meta["keys"], signatures)
+
+        return index
+
+
+def jaccard(first: set[int], second: set[int]) -> float:
+    if not first and not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def evaluate_recall(index: LSHIndex, fingerprint_sets: dict[str, set[int]], n_queries: int = 100, k: int = 10,
+                    threshold: float = 0.5, seed: int = 0) -> dict[str, float]:
+    """
+    Compare the index results to the exact Jaccard similarities for randomly selected indexed items. The relevant
+    neighbours of a query are the items with exact similarity >= threshold, recall@k is the ratio of the returned top-k
+    items that are relevant to the number of relevant items (at most k).
+
+    Args:
+        index: The index to evaluate
+        fingerprint_sets: The fingerprint sets of the indexed items by key
+        n_queries: Number of items to query
+        k: Number of neighbours to consider
+        threshold: Minimum exact Jaccard similarity of the relevant neighbours
+        seed: Random seed for selecting the queries
+
+    Returns: Dict with the recall, number of relevant neighbours and query times
+
+    """
+    query_keys = random.Random(seed).sample(sorted(fingerprint_sets), min(n_queries, len(fingerprint_sets)))
+
+    n_relevant = 0
+    n_found = 0
+    query_times = []
+
+    for query_key in query_keys:
+        query_set = fingerprint_sets[query_key]
+        relevant = {key for key, other_set in fingerprint_sets.items()
+                    if key != query_key and jaccard(query_set, other_set) >= threshold}
+
+        start = time.perf_counter()
+        results = index.query(query_set, k + 1)
+        query_times.append(time.perf_counter() - start)
+
+        found = [key for key, _ in results if key != query_key][:k]
+        n_relevant += min(k, len(relevant))
+        n_found += len(relevant.intersection(found))
+
+    query_times_ms = np.array(query_times or [0.0]) * 1000
+    return {
+        "recall": n_found / n_relevant if n_relevant else 1.0,
+        "n_relevant": n_relevant,
+        "mean_query_ms": float(query_times_ms.mean()),
+        "p95_query_ms": float(np.percentile(query_times_ms, 95)),
+    }
+
+
+def build_from_chtrees(chtree_root: Path | str, index: LSHIndex | None = None) -> tuple[LSHIndex, dict[str, set[int]]]:
+    """
+    Build (or incrementally extend) an index from the change trees saved by datasets.commit_repr_23summer. Change trees
+    already in the index and the ones without changed paths are skipped.
+
+    Args:
+        chtree_root: The change tree save root (summer23_chtree_root in the config)
+        index: An existing index to add the new change trees to
+
+    Returns: Tuple of: the index, the fingerprint sets of the newly added change trees by key
+
+    """
+    if index is None:
+        index = LSHIndex()
+
+    fingerprint_sets = {}
+    # Change trees already in the index are not loaded
+    for key, ch_tree in iter_saved_chtrees(chtree_root, skip=lambda key: key in index):
+        fingerprints = get_chtree_fingerprints(ch_tree)
+        if fingerprints:
+            index.add(key, fingerprints)
+            fingerprint_sets[key] = fingerprints
+
+    return index, fingerprint_sets
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="MinHash LSH index over saved change trees")
+    arg_parser.add_argument("command", choices=["build", "query", "evaluate"])
+    arg_parser.add_argument("index_path", help="Path to the index file (npz)")
+    arg_parser.add_argument("--chtree-root", help="Change tree save root, defaults to summer23_chtree_root")
+    arg_parser.add_argument("--chtree", help="Pickled change tree to query with")
+    arg_parser.add_argument("-k", type=int, default=10)
+    arg_parser.add_argument("--n-queries", type=int, default=100)
+    arg_parser.add_argument("--threshold", type=float, default=0.5)
+    args = arg_parser.parse_args()
+
+    chtree_root = args.chtree_root
+    if chtree_root is None:
+        from common.config import CONFIG
+        chtree_root = CONFIG.summer23_chtree_root
+
+    if args.command == "build":
+        index = LSHIndex.load(args.index_path) if Path(args.index_path).exists() else None
+        index, added = build_from_chtrees(chtree_root, index)
+        index.save(args.index_path)
+        print(f"Added {len(added)} change trees, index size: {len(index)}")
+    elif args.command == "query":
+        with Path(args.chtree).open("rb") as fp:
+            ch_tree = pickle.load(fp)
+        for key, similarity in LSHIndex.load(args.index_path).query(get_chtree_fingerprints(ch_tree), args.k):
+            print(f"{similarity:.3f} {key}")
+    else:
+        index = LSHIndex.load(args.index_path)
+        fingerprint_sets = {key: get_chtree_fingerprints(ch_tree) for key, ch_tree in
+                            iter_saved_chtrees(chtree_root, skip=lambda key: key not in index)}
+        print(evaluate_recall(index, fingerprint_sets, args.n_queries, args.k, args.threshold))
+
+
+if __name__ == '__main__':
+    main()
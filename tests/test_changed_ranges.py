@@ -0,0 +1,65 @@
+import random
+import time
+
+import pytest
+
+from tree_sitter_wrapper.tree import MAX_DIFFED_LINES, get_changed_ranges, get_line_edits
+
+SOURCE = b"""class A {
+    int f(int a) {
+        return a + 1;
+    }
+
+    int g(int b) {
+        return b * 2;
+    }
+}
+"""
+
+
+def apply_edits(pre_content: bytes, post_content: bytes, edits: list[tuple[int, int, int, int]]) -> bytes:
+    for pre_start, pre_end, post_start, post_end in reversed(edits):
+        pre_content = pre_content[:pre_start] + post_content[post_start:post_end] + pre_content[pre_end:]
+    return pre_content
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_line_edits(seed):
+    rng = random.Random(seed)
+    pre_lines = [f"line {rng.randrange(5)}\n".encode() for _ in range(rng.randrange(30))]
+    post_lines = list(pre_lines)
+    for _ in range(rng.randrange(5)):
+        idx = rng.randrange(len(post_lines) + 1)
+        if post_lines and rng.random() < 0.5:
+            del post_lines[min(idx, len(post_lines) - 1)]
+        else:
+            post_lines.insert(idx, f"new {rng.randrange(5)}\n".encode())
+    pre_content, post_content = b"".join(pre_lines), b"".join(post_lines)
+
+    edits = get_line_edits(pre_content, post_content)
+    assert apply_edits(pre_content, post_content, edits) == post_content
+    assert (edits == []) == (pre_content == post_content)
+
+
+def test_large_changed_region():
+    pre_content = b"x = 1;\n" * (4 * MAX_DIFFED_LINES)
+    post_content = b"head\n" + b"x = 1;\ny = 2;\n" * (2 * MAX_DIFFED_LINES) + b"tail\n"
+
+    start = time.perf_counter()
+    edits = get_line_edits(pre_content, post_content)
+    assert time.perf_counter() - start < 1
+
+    assert len(edits) == 1
+    assert apply_edits(pre_content, post_content, edits) == post_content
+
+
+def test_changed_ranges():
+    post_content = SOURCE.replace(b"b * 2", b"b * 3")
+    pre_tree, post_tree, pre_ranges, post_ranges = get_changed_ranges(SOURCE, post_content)
+
+    # The pre tree is not moved by the edits applied for the incremental parse
+    assert pre_tree.root.raw_node.end_byte == len(SOURCE)
+    assert post_tree.root.raw_node.end_byte == len(post_content)
+    changed_line = SOURCE.index(b"        return b * 2")
+    assert (changed_line, SOURCE.index(b"    }\n}")) in pre_ranges
+    assert all(start >= changed_line for start, _ in post_ranges)
@@ -0,0 +1,84 @@
+from pathlib import Path
+import json
+import os
+import time
+
+from pipeline.distributed import LEASES_DIR, ShardLease, ShardQueue, merge_shards, plan_shards, run_local
+
+N_SHARDS = 8
+
+
+def process_row(line: str, output_root: Path) -> None:
+    if line.startswith("fail"):
+        raise ValueError(line)
+    (output_root / f"{line}.txt").write_text(f"{line} by {os.getpid()}")
+
+
+def plan(work_dir: Path, n_rows: int = 40) -> list[str]:
+    lines = [f"row{idx}" for idx in range(n_rows)] + ["fail0"]
+    plan_shards(lines, work_dir, N_SHARDS, lambda line: line)
+    return lines
+
+
+def test_run_local(tmp_path: Path):
+    lines = plan(tmp_path / "work")
+
+    assert run_local(tmp_path / "work", process_row, 2, poll_interval=0.1) == N_SHARDS
+
+    stats = merge_shards(tmp_path / "work", tmp_path / "merged")
+    assert stats == {"merged_shards": N_SHARDS, "missing_shards": 0, "files": len(lines) - 1, "failures": 1}
+    assert sorted(path.stem for path in (tmp_path / "merged").iterdir()) == sorted(lines[:-1])
+    failures = [json.loads(line) for line in (tmp_path / "work" / "failures.jsonl").read_text().splitlines()]
+    assert [(failure["idx"], failure["error"]) for failure in failures] == [(len(lines) - 1, "ValueError")]
+
+
+def test_stale_lease_takeover(tmp_path: Path):
+    lines = plan(tmp_path / "work")
+    lease_path = tmp_path / "work" / LEASES_DIR / "0.lease"
+    lease_path.write_text("crashed-worker")
+    os.utime(lease_path, (time.time() - 120, time.time() - 120))
+
+    assert run_local(tmp_path / "work", process_row, 2, lease_timeout=60, poll_interval=0.1) == N_SHARDS
+    assert not lease_path.exists()
+    assert merge_shards(tmp_path / "work", tmp_path / "merged")["files"] == len(lines) - 1
+
+
+def test_live_lease_with_skewed_clock(tmp_path: Path, monkeypatch):
+    plan(tmp_path / "work")
+    lease_path = tmp_path / "work" / LEASES_DIR / "0.lease"
+    lease_path.write_text("live-worker")
+    # The clock of this node is an hour ahead of the filesystem
+    skewed_time = time.time
+    monkeypatch.setattr(time, "time", lambda: skewed_time() + 3600)
+
+    lease = ShardLease(lease_path, "other-worker", lease_timeout=60, heartbeat_interval=30)
+    assert not lease.try_acquire()
+    assert lease_path.read_text() == "live-worker"
+
+    claimed = ShardQueue(tmp_path / "work", lease_timeout=60).claim()
+    assert claimed is not None and claimed[0] != 0
+    claimed[1].release()
+
+
+def test_lease_taken_over_during_takeover(tmp_path: Path, monkeypatch):
+    plan(tmp_path / "work")
+    lease_path = tmp_path / "work" / LEASES_DIR / "0.lease"
+    lease_path.write_text("crashed-worker")
+    os.utime(lease_path, (time.time() - 120, time.time() - 120))
+
+    lease = ShardLease(lease_path, "slow-worker", lease_timeout=60, heartbeat_interval=30)
+    get_filesystem_time = lease.get_filesystem_time
+    taken_over = []
+
+    def take_over_first() -> float:
+        # Another worker replaces the expired lease after this one found it expired
+        if not taken_over:
+            lease_path.unlink()
+            lease_path.write_text("fast-worker")
+            taken_over.append(True)
+        return get_filesystem_time()
+
+    monkeypatch.setattr(lease, "get_filesystem_time", take_over_first)
+    assert not lease.try_acquire()
+    assert lease_path.read_text() == "fast-worker"
+    assert [path.name for path in lease_path.parent.iterdir()] == ["0.lease"]
@@ -0,0 +1,96 @@
+from pathlib import Path
+import subprocess
+
+import pytest
+
+from common.util.git_objects import LocalGitBackend, MAX_UNTHREADED_REQUEST_SIZE
+
+
+def git(*args: str, cwd: Path) -> str:
+    return subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=cwd,
+                          check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def mirrors(tmp_path: Path) -> tuple[Path, list[str]]:
+    """A mirror of "owner/name" with two commits, and the shas of the commits."""
+    work = tmp_path / "work"
+    (work / "src").mkdir(parents=True)
+    git("init", "-q", cwd=work)
+
+    shas = []
+    for version in range(2):
+        (work / "src" / "A.java").write_text(f"class A {{ int v = {version}; }}\n")
+        git("add", "-A", cwd=work)
+        git("commit", "-q", "-m", f"version {version}", cwd=work)
+        shas.append(git("rev-parse", "HEAD", cwd=work))
+
+    mirrors_root = tmp_path / "mirrors"
+    (mirrors_root / "owner").mkdir(parents=True)
+    git("clone", "-q", "--bare", str(work), str(mirrors_root / "owner" / "name.git"), cwd=tmp_path)
+
+    return mirrors_root, shas
+
+
+def test_read_files(mirrors):
+    mirrors_root, shas = mirrors
+    with LocalGitBackend(mirrors_root) as backend:
+        assert backend.has_repo("owner/name")
+        assert not backend.has_repo("owner/other")
+
+        contents = backend.read_files("owner/name", [(shas[0], "src/A.java"), (f"{shas[1]}\n", "src\\A.java")])
+        assert contents == [b"class A { int v = 0; }\n", b"class A { int v = 1; }\n"]
+
+
+def test_missing_objects(mirrors):
+    mirrors_root, shas = mirrors
+    with LocalGitBackend(mirrors_root) as backend:
+        contents = backend.read_files("owner/name", [
+            (shas[0], "src/Missing.java"),
+            ("0" * 40, "src/A.java"),
+            (shas[0], "src"),
+            (shas[0], "src/a b.java"),
+            (shas[1], "src/A.java"),
+        ])
+        assert contents == [None, None, None, None, b"class A { int v = 1; }\n"]
+
+
+def test_large_batch(mirrors):
+    mirrors_root, shas = mirrors
+    files = [(shas[idx % 2], "src/A.java" if idx % 3 else "src/Missing.java") for idx in range(3000)]
+    assert sum(len(f"{sha}:{path}\n") for sha, path in files) > MAX_UNTHREADED_REQUEST_SIZE
+
+    with LocalGitBackend(mirrors_root) as backend:
+        contents = backend.read_files("owner/name", files)
+
+    expected = {shas[0]: b"class A { int v = 0; }\n", shas[1]: b"class A { int v = 1; }\n"}
+    assert contents == [None if path.endswith("Missing.java") else expected[sha] for sha, path in files]
+
+
+def test_restart_after_exit(mirrors):
+    mirrors_root, shas = mirrors
+    with LocalGitBackend(mirrors_root) as backend:
+        backend.read_files("owner/name", [(shas[0], "src/A.java")])
+        cat_file = backend.cat_files["owner/name"]
+        cat_file.process.kill()
+        cat_file.process.wait()
+
+        assert backend.read_files("owner/name", [(shas[1], "src/A.java")]) == [b"class A { int v = 1; }\n"]
+        assert backend.cat_files["owner/name"] is not cat_file
+
+
+def test_restart_after_error(mirrors, monkeypatch):
+    mirrors_root, shas = mirrors
+    with LocalGitBackend(mirrors_root) as backend:
+        backend.read_files("owner/name", [(shas[0], "src/A.java")])
+        cat_file = backend.cat_files["owner/name"]
+
+        def fail() -> None:
+            raise OSError("read failed")
+
+        monkeypatch.setattr(cat_file, "read_object", fail)
+        with pytest.raises(OSError):
+            backend.read_files("owner/name", [(shas[0], "src/A.java")])
+        assert not cat_file.is_alive()
+
+        assert backend.read_files("owner/name", [(shas[1], "src/A.java")]) == [b"class A { int v = 1; }\n"]
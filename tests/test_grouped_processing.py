@@ -0,0 +1,88 @@
+from pathlib import Path
+import random
+
+import pytest
+
+if not Path("config.yaml").exists():
+    pytest.skip("The dataset script needs a config.yaml (see config_default.yaml)", allow_module_level=True)
+
+from datasets import commit_repr_23summer
+from datasets.commit_repr_23summer import (chtree_from_contents, parse_post_commit_method_def,
+                                           parse_pre_commit_method_def, process_file_group)
+
+PRE_CONTENT = b"""package a;
+
+class A {
+    private int v;
+
+    A(int v) {
+        this.v = v;
+    }
+
+    int f(int x) {
+        return x + v;
+    }
+
+    Runnable g() {
+        return new Runnable() {
+            public void run() {
+                System.out.println(v);
+            }
+        };
+    }
+}
+"""
+
+POST_CONTENT = PRE_CONTENT.replace(b"this.v = v;", b"this.v = Math.abs(v);") \
+    .replace(b"return x + v;", b"int y = x * 2;\n        return y + v;") \
+    .replace(b"println(v)", b"println(v + 1)")
+
+# (identifier, pre line, post line), lines are 0-based like the positions of the dataset
+ROWS = [
+    ("A", 5, 5),
+    ("f", 9, 9),
+    ("f", 10, 11),
+    ("run", 16, 17),
+    ("g", 13, 14),
+    ("missing", 0, 0),
+]
+
+
+def get_csv_line(identifier: str, pre_line: int, post_line: int) -> str:
+    return ",".join(["owner/name", "pre_url", "post_url", "src/A.java", "src/A.java", f"{pre_line}:4",
+                     f"{post_line}:4", identifier, "pre_sha", "post_sha"])
+
+
+def get_summary(ch_tree) -> tuple:
+    return ([repr(path) for path in ch_tree.before_paths], [repr(path) for path in ch_tree.after_paths],
+            ch_tree.method_sizes)
+
+
+def test_grouped_like_row_by_row(monkeypatch):
+    monkeypatch.setattr(commit_repr_23summer, "read_commit_files", lambda *_: (PRE_CONTENT, POST_CONTENT))
+    monkeypatch.setattr(commit_repr_23summer, "save_chtree", lambda *_: None)
+    lines = [(idx, get_csv_line(*row)) for idx, row in enumerate(ROWS)]
+
+    expected = []
+    for _, line in lines:
+        random.seed(0)
+        try:
+            ch_tree = chtree_from_contents(PRE_CONTENT, POST_CONTENT, parse_pre_commit_method_def(line),
+                                           parse_post_commit_method_def(line))
+            expected.append(get_summary(ch_tree))
+        except Exception as ex:
+            expected.append(type(ex))
+
+    grouped = []
+    results = process_file_group(lines)
+    for idx, _ in lines:
+        random.seed(0)
+        result_idx, ch_tree, post_method, error, _ = next(results)
+        assert result_idx == idx and post_method.identifier == ROWS[idx][0]
+        grouped.append(type(error) if error else get_summary(ch_tree))
+
+    assert grouped == expected
+    # The constructor, both rows of f and g are found (a line of the anonymous class in g locates g, like
+    # get_method_by_pos does), the line outside the methods fails
+    assert [isinstance(summary, tuple) for summary in grouped] == [True] * 5 + [False]
+    assert len({summary[2] for summary in grouped[:5]}) == 3
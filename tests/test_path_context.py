@@ -0,0 +1,59 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from path_context.extractor import PathContextExtractor
+from path_context.flat_tree import FlatTree
+from tree_sitter_wrapper.tree import get_sitter_AST_bytes
+
+SOURCE = b"""
+class A {
+    int f(int a, int b) {
+        int x = a + b * 2;
+        if (x > 10) { x = g(x, a); } else { x -= b; }
+        for (int i = 0; i < b; i++) { a += obj.h(i).field; }
+        return x + a;
+    }
+}
+"""
+
+
+def get_valid_pairs_brute_force(tree: FlatTree, max_length: int, max_width: int, named_only: bool) -> list[tuple]:
+    pairs = []
+    for start, end in itertools.combinations(tree.get_leaves(named_only).tolist(), 2):
+        node, start_ancestors = start, {start}
+        while tree.parents[node] >= 0:
+            node = int(tree.parents[node])
+            start_ancestors.add(node)
+        lca = end
+        while lca not in start_ancestors:
+            lca = int(tree.parents[lca])
+        up, down = tree.get_path(start, end, lca)
+        if len(up) - 1 + len(down) <= max_length and \
+                abs(tree.sibling_idxs[up[-2]] - tree.sibling_idxs[down[0]]) <= max_width:
+            pairs.append((start, end, lca))
+
+    return pairs
+
+
+@pytest.mark.parametrize("max_length, max_width, named_only", [(8, 2, True), (4, 1, False), (12, 3, True)])
+def test_valid_pairs(max_length, max_width, named_only):
+    tree = FlatTree(get_sitter_AST_bytes(SOURCE).root.raw_node)
+    extractor = PathContextExtractor(max_length, max_width, named_leaves_only=named_only)
+
+    pairs = list(zip(*(nodes.tolist() for nodes in extractor.get_valid_pairs(tree))))
+    assert pairs == get_valid_pairs_brute_force(tree, max_length, max_width, named_only)
+
+
+def test_extract_changed():
+    post_source = SOURCE.replace(b"x -= b", b"x -= c")
+    pre_tree, post_tree = (FlatTree(get_sitter_AST_bytes(source).root.raw_node) for source in (SOURCE, post_source))
+    extractor = PathContextExtractor(max_contexts=None)
+
+    before_only, after_only = extractor.extract_changed(pre_tree, post_tree)
+    before_all, after_all = (set(map(tuple, extractor.extract(tree).tolist())) for tree in (pre_tree, post_tree))
+
+    assert set(map(tuple, before_only.tolist())) == before_all - after_all
+    assert set(map(tuple, after_only.tolist())) == after_all - before_all
+    assert "c" in {extractor.strings[token] for token in after_only[:, [0, 2]].ravel().tolist()}
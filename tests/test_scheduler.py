@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from pipeline.scheduler import Stage, StagedPipeline
+
+
+def square(x: int) -> int:
+    return x * x
+
+
+def fail_on_three(x: int) -> int:
+    if x == 3:
+        raise ValueError("three")
+    return x
+
+
+def run_in_thread(pipeline: StagedPipeline, items) -> tuple[list, list]:
+    """Run the pipeline on a thread, so a hanging pipeline fails the test instead of blocking it."""
+    results, errors = [], []
+
+    def run() -> None:
+        try:
+            results.extend(pipeline.run(items))
+        except Exception as ex:
+            errors.append(ex)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "The pipeline did not finish"
+
+    return results, errors
+
+
+def test_run():
+    pipeline = StagedPipeline([Stage("check", fail_on_three, 2), Stage("square", square, 3)])
+    results, errors = run_in_thread(pipeline, ((x, x) for x in range(10)))
+
+    assert not errors
+    assert {result.key: result.value for result in results if result.error is None} == \
+        {x: x * x for x in range(10) if x != 3}
+    failed = [result for result in results if result.error is not None]
+    assert [(result.key, result.failed_stage) for result in failed] == [(3, "check")]
+    assert set(failed[0].stage_times) == {"check"}
+
+
+def test_run_with_processes():
+    pipeline = StagedPipeline([Stage("square", square, 2, use_processes=True)])
+    results, errors = run_in_thread(pipeline, ((x, x) for x in range(10)))
+
+    assert not errors
+    assert sorted(result.value for result in results) == [x * x for x in range(10)]
+
+
+def test_failing_items():
+    def items():
+        yield from ((x, x) for x in range(5))
+        raise RuntimeError("items failed")
+
+    pipeline = StagedPipeline([Stage("square", square, 2)])
+    results, errors = run_in_thread(pipeline, items())
+
+    assert sorted(result.value for result in results) == [x * x for x in range(5)]
+    assert len(errors) == 1 and str(errors[0]) == "items failed"
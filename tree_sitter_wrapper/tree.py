@@ -1,9 +1,11 @@
 from __future__ import annotations
 
-from tree_sitter import Language, Parser
+from tree_sitter import Language, Parser, Tree
+from difflib import SequenceMatcher
 from itertools import chain
 from typing import Iterator
 import random
+import time
 from pathlib import Path
 
 from tree_sitter_wrapper.node import Node, update_visited_nodes
@@ -22,6 +24,11 @@ JAVA_LANGUAGE = Language("tree_sitter_wrapper/build/my-languages.so", "java")
 parser = Parser()
 parser.set_language(JAVA_LANGUAGE)
 
+METHOD_NODE_TYPES = ("method_declaration", "constructor_declaration")
+# Line diffs are quadratic in the worst case (repetitive or generated files): a changed region of more lines than this
+# in either version is taken as one replaced range instead
+MAX_DIFFED_LINES = 2000
+
 
 class TreeSitterTree:
     def __init__(self, root_node: Node):
@@ -120,6 +127,33 @@ class TreeSitterTree:
 
         return root_paths
 
+    def get_change_focused_root_paths(self, n_paths: int, changed_ranges: list[tuple[int, int]],
+                                      n_context_leaves: int = 2) -> list[RootPath]:
+        """
+        Get the root paths of the leaves inside the changed byte ranges and of their neighbouring leaves. If there are
+        more such leaves than n_paths, they are randomly sampled.
+
+        Args:
+            n_paths: Maximum number of root paths to get
+            changed_ranges: List of (start byte, end byte) ranges, see get_changed_ranges
+            n_context_leaves: Number of leaves to include before and after every changed leaf
+
+        Returns:
+            List of root paths in the order of the leaves
+        """
+        leaves = [node for node in self.traverse() if node.raw_node.child_count == 0]
+
+        focused_idxs = set()
+        for idx, leaf in enumerate(leaves):
+            if any(is_overlapping(leaf.raw_node, start, end) for start, end in changed_ranges):
+                focused_idxs.update(range(max(0, idx - n_context_leaves), idx + n_context_leaves + 1))
+
+        focused_idxs = sorted(idx for idx in focused_idxs if idx < len(leaves))
+        if len(focused_idxs) > n_paths:
+            focused_idxs = sorted(random.sample(focused_idxs, n_paths))
+
+        return [self.get_root_path(leaves[idx]) for idx in focused_idxs]
+
     def get_root_paths(self, n_max_root_paths: int) -> list[RootPath]:
         """Get a number of root paths for the leaf nodes in the tree while traversing the tree in a BFS manner
 
@@ -154,6 +188,59 @@ class TreeSitterTree:
             if method_root.start_point[0] <= line <= method_root.end_point[0]:
                 return TreeSitterTree(method.root)
 
+    def get_method_index(self) -> list[RawNode]:
+        """
+        Get every method and constructor in the order get_method_by_pos checks them, with a single traversal. Several
+        methods of the tree can then be located without traversing it again, see get_method_from_index.
+        """
+        methods, constructors = [], []
+        for node in self.traverse():
+            if node.type == "method_declaration":
+                methods.append(node.raw_node)
+            elif node.type == "constructor_declaration":
+                constructors.append(node.raw_node)
+
+        return methods + constructors
+
+    def get_method_by_byte_range(self, start_byte: int, end_byte: int) -> TreeSitterTree | None:
+        """
+        Get the method spanning a byte range without traversing the whole tree.
+
+        Args:
+            start_byte: Start byte of the method (inclusive)
+            end_byte: End byte of the method (exclusive)
+
+        Returns:
+            The method subtree, or None if the range does not correspond to a method
+        """
+        raw_node = self.root.raw_node.descendant_for_byte_range(start_byte, end_byte)
+
+        while raw_node and raw_node.type not in METHOD_NODE_TYPES:
+            raw_node = raw_node.parent
+
+        if raw_node is None or (raw_node.start_byte, raw_node.end_byte) != (start_byte, end_byte):
+            return None
+
+        return TreeSitterTree(Node(raw_node))
+
+
+def get_method_from_index(method_index: list[RawNode], line: int) -> TreeSitterTree | None:
+    """
+    Get the method at a line like TreeSitterTree.get_method_by_pos, from the method index of the tree
+
+    Args:
+        method_index: See TreeSitterTree.get_method_index
+        line: The line of the method
+
+    Returns: The method subtree, or None if there is no method at the line
+
+    """
+    for raw_node in method_index:
+        if raw_node.start_point[0] <= line <= raw_node.end_point[0]:
+            return TreeSitterTree(Node(raw_node))
+
+    return None
+
 
 def get_sitter_AST_file(filepath: Path | str) -> TreeSitterTree:
     """
@@ -170,10 +257,169 @@ def get_sitter_AST_file(filepath: Path | str) -> TreeSitterTree:
     with filepath.open("rb") as fp:
         file_content = fp.read(-1)
 
-    ast = parser.parse(file_content)
+    return get_sitter_AST_bytes(file_content)
+
+
+def parse_bytes(content: bytes, old_tree: Tree | None = None, timeout: float | None = None) -> Tree:
+    """
+    Parse source code with the Java parser
+
+    Args:
+        content: The source code
+        old_tree: The edited tree of the previous version of the content, for incremental parsing
+        timeout: Seconds after which parsing is aborted with a TimeoutError, None for no limit
+
+    Returns: The tree-sitter tree
+
+    """
+    parser.set_timeout_micros(int(timeout * 1e6) if timeout else 0)
+    try:
+        return parser.parse(content, old_tree) if old_tree else parser.parse(content)
+    except ValueError as ex:
+        # The next parse would resume the aborted one
+        parser.reset()
+        if timeout:
+            raise TimeoutError(f"Parsing did not finish in {timeout}s") from ex
+        raise
+
+
+def get_sitter_AST_bytes(content: bytes, timeout: float | None = None) -> TreeSitterTree:
+    """
+    Extract the AST for the content of a file
+
+    Args:
+        content: The source code to extract AST for
+        timeout: Seconds after which parsing is aborted with a TimeoutError, None for no limit
+
+    Returns: TreeSitterTree object
+
+    """
+    ast = parse_bytes(content, timeout=timeout)
     return TreeSitterTree(Node(ast.root_node))
 
 
+def is_overlapping(raw_node: RawNode, start_byte: int, end_byte: int) -> bool:
+    """Check if a node overlaps a byte range, empty ranges (deletions) overlap the nodes they touch."""
+    if start_byte == end_byte:
+        return raw_node.start_byte <= start_byte <= raw_node.end_byte
+    return raw_node.start_byte < end_byte and start_byte < raw_node.end_byte
+
+
+def get_point(content: bytes, byte_offset: int) -> tuple[int, int]:
+    """Get the (row, column) point of a byte offset."""
+    row = content.count(b"\n", 0, byte_offset)
+    return row, byte_offset - (content.rfind(b"\n", 0, byte_offset) + 1)
+
+
+def get_line_edits(pre_content: bytes, post_content: bytes) -> list[tuple[int, int, int, int]]:
+    """
+    Get the line based edits turning one content into another. The common leading and trailing lines are skipped, and
+    a changed region of more than MAX_DIFFED_LINES lines is a single edit.
+
+    Args:
+        pre_content: The content before the change
+        post_content: The content after the change
+
+    Returns: List of (pre start byte, pre end byte, post start byte, post end byte) tuples in increasing order
+
+    """
+    pre_lines = pre_content.splitlines(keepends=True)
+    post_lines = post_content.splitlines(keepends=True)
+    pre_offsets = [0]
+    for line in pre_lines:
+        pre_offsets.append(pre_offsets[-1] + len(line))
+    post_offsets = [0]
+    for line in post_lines:
+        post_offsets.append(post_offsets[-1] + len(line))
+
+    n_common = min(len(pre_lines), len(post_lines))
+    prefix = 0
+    while prefix < n_common and pre_lines[prefix] == post_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n_common - prefix and pre_lines[-1 - suffix] == post_lines[-1 - suffix]:
+        suffix += 1
+
+    pre_end, post_end = len(pre_lines) - suffix, len(post_lines) - suffix
+    if prefix == pre_end and prefix == post_end:
+        return []
+    if max(pre_end, post_end) - prefix > MAX_DIFFED_LINES:
+        return [(pre_offsets[prefix], pre_offsets[pre_end], post_offsets[prefix], post_offsets[post_end])]
+
+    matcher = SequenceMatcher(None, pre_lines[prefix:pre_end], post_lines[prefix:post_end], autojunk=False)
+    return [(pre_offsets[prefix + i1], pre_offsets[prefix + i2], post_offsets[prefix + j1], post_offsets[prefix + j2])
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def get_changed_ranges(pre_content: bytes, post_content: bytes, timeout: float | None = None) \
+        -> tuple[TreeSitterTree, TreeSitterTree, list[tuple[int, int]], list[tuple[int, int]]]:
+    """
+    Parse both versions of a file, the post version incrementally from the pre version, and get the byte ranges that
+    changed. Tree-sitter only reports the ranges whose syntactic structure changed, so the edited ranges themselves
+    (e.g. a changed literal) are added too.
+
+    Args:
+        pre_content: The file content before the change
+        post_content: The file content after the change
+        timeout: Seconds after which parsing is aborted with a TimeoutError, None for no limit
+
+    Returns: Tuple of: pre tree, post tree, changed ranges in pre, changed ranges in post
+
+    """
+    deadline = time.perf_counter() + timeout if timeout else None
+    get_remaining = lambda: max(deadline - time.perf_counter(), 1e-6) if deadline else None
+
+    edits = get_line_edits(pre_content, post_content)
+
+    pre_tree = parse_bytes(pre_content, timeout=get_remaining())
+    # Reparsing with the unedited tree reuses all of it, a cheap copy whose edits do not change pre_tree
+    edited_tree = parse_bytes(pre_content, pre_tree, get_remaining())
+
+    # Apply the edits from the back, so the positions of the not yet applied edits stay valid
+    for pre_start, pre_end, post_start, post_end in reversed(edits):
+        start_point = get_point(pre_content, pre_start)
+        inserted = post_content[post_start:post_end]
+        n_newlines = inserted.count(b"\n")
+        if n_newlines:
+            new_end_point = (start_point[0] + n_newlines, len(inserted) - inserted.rfind(b"\n") - 1)
+        else:
+            new_end_point = (start_point[0], start_point[1] + len(inserted))
+
+        edited_tree.edit(
+            start_byte=pre_start,
+            old_end_byte=pre_end,
+            new_end_byte=pre_start + len(inserted),
+            start_point=start_point,
+            old_end_point=get_point(pre_content, pre_end),
+            new_end_point=new_end_point,
+        )
+
+    post_tree = parse_bytes(post_content, edited_tree, get_remaining())
+
+    pre_ranges = [(pre_start, pre_end) for pre_start, pre_end, _, _ in edits]
+    post_ranges = [(post_start, post_end) for _, _, post_start, post_end in edits]
+
+    for changed_range in edited_tree.changed_ranges(post_tree):
+        post_ranges.append((changed_range.start_byte, changed_range.end_byte))
+        pre_ranges.append((to_pre_offset(changed_range.start_byte, edits, True),
+                           to_pre_offset(changed_range.end_byte, edits, False)))
+
+    return TreeSitterTree(Node(pre_tree.root_node)), TreeSitterTree(Node(post_tree.root_node)), pre_ranges, post_ranges
+
+
+def to_pre_offset(post_offset: int, edits: list[tuple[int, int, int, int]], is_start: bool) -> int:
+    """Map a byte offset of the post content to the pre content, offsets inside an edit snap to the edited range."""
+    delta = 0
+    for pre_start, pre_end, post_start, post_end in edits:
+        if post_offset < post_start:
+            break
+        if post_offset <= post_end:
+            return pre_start if is_start else pre_end
+        delta = pre_end - post_end
+
+    return post_offset + delta
+
+
 def get_sitter_AST_method(filepath: Path | str, commit_method: CommitMethodDefinition) -> TreeSitterTree:
     """
     Parses the TreeSitter AST for a method